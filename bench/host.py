@@ -0,0 +1,67 @@
+"""Prepares a CPython process to import the firmware modules from source/.
+
+The stand-in modules in shims/ replace the MicroPython ones (machine, rp2,
+uctypes, utime, micropython, network, ntptime, u* aliases), time gains the
+MicroPython ticks_* and sleep_* functions and gc gains mem_alloc/mem_free.
+load_main() then imports source/main.py without starting it.
+"""
+
+import importlib.util
+import os
+import sys
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SHIMS_DIR = os.path.join(BENCH_DIR, "shims")
+SOURCE_DIR = os.path.join(os.path.dirname(BENCH_DIR), "source")
+
+
+def install():
+    for path in (SOURCE_DIR, SHIMS_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    import _clock  # noqa: F401
+    import _heap  # noqa: F401
+
+    # _thread is built into CPython, the stand-in has to be swapped in by hand.
+    # threading keeps the real one, so host-side helper threads still work.
+    import threading  # noqa: F401
+
+    if getattr(sys.modules["_thread"], "__file__", None):
+        return  # Installed already
+
+    spec = importlib.util.spec_from_file_location(
+        "_thread", os.path.join(SHIMS_DIR, "_thread.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules["_thread"] = module
+
+
+def load_main(**config):
+    # A fresh main module, configured with config on top of a minimal config
+    # module. The final main() call is left out: nothing connects or runs, the
+    # caller drives the handlers. Relative paths (state files) are in the cwd.
+    module = types.ModuleType("config")
+    module.SSID = "bench"
+    module.PASSWORD = "bench"
+    module.MQTT_HOST = "localhost"
+    module.MQTT_PORT = 1883
+    module.MQTT_USER = None
+    module.MQTT_PASSWORD = None
+    module.NAME = "Bench"
+    for name, value in config.items():
+        setattr(module, name, value)
+    sys.modules["config"] = module
+
+    path = os.path.join(SOURCE_DIR, "main.py")
+    with open(path) as f:
+        source = f.read()
+    source = source[: source.rstrip().rindex("main()")]
+
+    main = types.ModuleType("main")
+    main.__file__ = path
+    sys.modules["main"] = main
+    exec(compile(source, path, "exec"), main.__dict__)
+    return main
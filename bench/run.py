@@ -0,0 +1,1335 @@
+"""Host-side microbenchmarks for the firmware modules.
+
+Runs on plain CPython with the stand-ins from shims/:
+
+    python bench/run.py [--output bench-results.json] [--only encode,mqtt]
+
+Every benchmark returns a dict of numbers; the whole run is written as JSON
+so results can be compared between commits. Figures are CPython figures,
+useful to compare changes against each other rather than to predict
+RP2040 timings. Checks (such as allocation free paths) are reported under
+"checks" and make the run exit with status 1 when they fail.
+"""
+
+import argparse
+import dis
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+import host
+
+host.install()
+
+import corpus  # noqa: E402
+import daikindecoder  # noqa: E402
+import daikinencoder  # noqa: E402
+import daikinremote  # noqa: E402
+import dispatch  # noqa: E402
+import eventloop  # noqa: E402
+import irbackend  # noqa: E402
+import ircalib  # noqa: E402
+import irstats  # noqa: E402
+import rp2  # noqa: E402
+import scheduler  # noqa: E402
+import statestore  # noqa: E402
+import usocket  # noqa: E402
+from umqtt import robust, simple  # noqa: E402
+
+MODES = ["auto", "off", "cool", "heat", "dry", "fan_only"]
+FAN_MODES = ["Auto", "Quiet", "1", "2", "3", "4", "5"]
+ALL_STATES = [
+    (power, mode, str(temperature), fan)
+    for power in ("on", "off")
+    for mode in MODES
+    for temperature in range(daikinremote.MIN_TEMP, daikinremote.MAX_TEMP + 1)
+    for fan in FAN_MODES
+]
+
+CHECKS = {}
+
+
+def check(name, ok, detail):
+    CHECKS[name] = {"ok": bool(ok), "detail": detail}
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = time.perf_counter() - start
+    return {
+        "repeat": repeat,
+        "total_s": round(elapsed, 6),
+        "us_per_op": round(elapsed * 1e6 / repeat, 3),
+        "ops_per_s": round(repeat / elapsed, 1) if elapsed else None,
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(errors):
+    return {
+        "count": len(errors),
+        "mean": round(sum(errors) / len(errors), 3) if errors else 0,
+        "p99": percentile(errors, 0.99),
+        "max": max(errors) if errors else 0,
+    }
+
+
+# CPython boxes every int above 256, MicroPython keeps ints below 2**30 in the
+# object pointer: an opcode creating one such int doesn't allocate
+_INT_BYTES = (sys.getsizeof(1 << 29) + 7) & ~7
+
+# While tracing, CPython reports a builtin method call with a bound method it
+# makes for the occasion, and unpacks sequences through an iterator
+_BOUND_BUILTIN_BYTES = sys.getsizeof([].append)
+_UNPACK_BYTES = max(sys.getsizeof(iter(())), sys.getsizeof(iter([])))
+
+
+def _host_allocations(code):
+    # Opcodes of code (by offset) that allocate on CPython only, with the bytes
+    # they may allocate, None for any amount. MicroPython runs for loops on a
+    # stack iterator without a range object, slices built-in types through a
+    # stack slice (CPython copies what is stored into a slice first) and looks
+    # super() methods up without a super object.
+    allowed = {}
+    openers = []
+    previous = callee = None
+    for instr in dis.get_instructions(code):
+        name = instr.opname
+        if name in ("PRECALL", "CACHE"):
+            continue
+
+        if name in ("GET_ITER", "FOR_ITER", "BUILD_SLICE"):
+            allowed[instr.offset] = None
+            if name == "GET_ITER" and callee == "range":
+                allowed[previous.offset] = None
+        elif name == "STORE_SUBSCR" and previous.opname == "BUILD_SLICE":
+            allowed[instr.offset] = None
+        elif name == "LOAD_METHOD" and callee == "super":
+            allowed[instr.offset] = None
+        elif name == "UNPACK_SEQUENCE":
+            allowed[instr.offset] = _UNPACK_BYTES
+
+        # Calls are matched with the instruction that loaded their callable
+        callee = None
+        if name in ("PUSH_NULL", "LOAD_METHOD") or (
+            name == "LOAD_GLOBAL" and instr.arg & 1
+        ):
+            openers.append(instr)
+        elif name in ("CALL", "CALL_FUNCTION_EX") and openers:
+            opener = openers.pop()
+            if opener.opname == "LOAD_METHOD":
+                allowed[instr.offset] = _BOUND_BUILTIN_BYTES
+            elif opener.opname == "LOAD_GLOBAL":
+                callee = opener.argval
+                if callee == "super":
+                    allowed[instr.offset] = None
+        previous = instr
+    return allowed
+
+
+class _Discard:
+    # Static, print() doesn't make a bound method to call them
+    @staticmethod
+    def write(s):
+        return len(s)
+
+    @staticmethod
+    def flush():
+        pass
+
+
+def allocations(fn, repeat, warmup=1):
+    # Heap allocations made by firmware code over repeat calls to fn, in this
+    # thread. Every opcode of source/ runs with the tracemalloc peak reset
+    # before it, so objects freed right away are counted too. Returns the
+    # allocating lines with how many times they allocated. CPython's free
+    # lists hide small tuples, lists and dicts.
+    found = {}
+    allowed = {}
+    # Line of the opcode being traced (None outside source/), traced size
+    # before it, scratch, bytes it may allocate on CPython only and the frame
+    # that returned last
+    window = [None, 0, 0, 0, None]
+
+    def trace(frame, event, arg):
+        window[2] = tracemalloc.get_traced_memory()[1] - window[1]
+        if event == "call":
+            # Tracing made a frame object for the callee
+            window[2] -= sys.getsizeof(frame)
+        if (
+            window[0] is not None
+            and window[3] is not None
+            and window[2] - window[3] > _INT_BYTES
+        ):
+            found[window[0]] = found.get(window[0], 0) + 1
+
+        # A returning frame is kept until the next event: freed in the middle
+        # of its caller's opcode, it would hide as many bytes allocated there
+        window[4] = None
+        if event == "return":
+            window[4] = frame
+            frame = frame.f_back
+        code = frame.f_code
+        source = code.co_filename.startswith(host.SOURCE_DIR)
+        if event == "call":
+            frame.f_trace_lines = False
+            frame.f_trace_opcodes = source
+
+        window[0] = None
+        if source and (event == "opcode" or event == "return"):
+            if code not in allowed:
+                allowed[code] = _host_allocations(code)
+            window[0] = "%s:%d" % (
+                os.path.basename(code.co_filename),
+                frame.f_lineno or code.co_firstlineno,
+            )
+            window[3] = allowed[code].get(frame.f_lasti, 0)
+
+        tracemalloc.reset_peak()
+        window[1] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return trace
+
+    # The peak is shared by every thread: others only get to run while fn
+    # blocks, outside of source/. Printing allocates on CPython only.
+    interval = sys.getswitchinterval()
+    stdout = sys.stdout
+    sys.setswitchinterval(60)
+    sys.stdout = _Discard()
+    tracemalloc.start()
+    sys.settrace(trace)
+    try:
+        # Warmup calls run traced, CPython sets tracing up on first use
+        for i in range(warmup + repeat):
+            if i == warmup:
+                found.clear()
+            fn()
+    finally:
+        sys.settrace(None)
+        tracemalloc.stop()
+        sys.stdout = stdout
+        sys.setswitchinterval(interval)
+    return found
+
+
+# Encoder
+
+
+def bench_encode(quick):
+    states = iter(ALL_STATES * 100)
+
+    def encode():
+        state_raw = daikinremote.prepare_state(*next(states))
+        daikinencoder.get_frames(state_raw)
+
+    cache = daikinremote.StateCache(8)
+    keys = [daikinremote.state_key(*state) for state in ALL_STATES[:8]]
+    hits = iter(keys * 10000)
+
+    # Misses cycle through more states than the cache holds
+    miss_cache = daikinremote.StateCache(8)
+    misses = iter([daikinremote.state_key(*state) for state in ALL_STATES] * 10)
+
+    # Incremental checksums against a full recompute after random field changes
+    state = daikinencoder.DaikinState()
+    rng = random.Random(13)
+    mismatches = 0
+    for _ in range(200 if quick else 2000):
+        state.set_temperature(rng.randrange(10, 33))
+        state.set_fan(rng.choice([3, 4, 5, 6, 7, 0xA, 0xB]))
+        state.set_time(rng.randrange(1440))
+        state.set_day_of_week(rng.randrange(1, 8))
+        reference = daikinencoder.DaikinState(state.raw)
+        if reference.raw != state.raw:
+            mismatches += 1
+    check("daikin_state_incremental_sums", mismatches == 0, mismatches)
+
+    def change_field():
+        state.set_temperature(rng.randrange(10, 33))
+
+    return {
+        "states": len(ALL_STATES),
+        "prepare_state_get_frames": timed(encode, 500 if quick else len(ALL_STATES)),
+        "cache_hit": timed(lambda: cache.get(next(hits)), 2000 if quick else 20000),
+        "cache_miss": timed(
+            lambda: miss_cache.get(next(misses)), 500 if quick else len(ALL_STATES)
+        ),
+        "daikin_state_set_field": timed(change_field, 2000 if quick else 20000),
+    }
+
+
+# IR symbol generation and replay
+
+
+def bench_blast(quick):
+    frames = [
+        daikinencoder.get_frames(daikinremote.prepare_state(*state))
+        for state in ALL_STATES[:64]
+    ]
+    train = irbackend.array("H", [0] * daikinremote.PULSE_TRAIN_SIZE)
+    it = iter(frames * 1000)
+    recorder = irbackend.RecordingBackend()
+
+    result = {
+        "symbols": daikinremote.PULSE_TRAIN_SIZE,
+        "encode_pulse_train": timed(
+            lambda: daikinremote.encode_pulse_train(next(it), train),
+            200 if quick else 2000,
+        ),
+        "recording_send": timed(lambda: recorder.send(train), 200 if quick else 2000),
+    }
+
+    # Replay through the CPU backend against a recording PWM: commanded
+    # versus observed duration of every symbol.
+    backend = irbackend.PWMBackend(13)
+    backend._pwm.recording = True
+    backend.send(train)
+    log = backend._pwm.log
+    errors = [
+        abs((log[i + 1][0] - log[i][0]) - train[i]) for i in range(len(train))
+    ]
+    result["pwm_replay_error_us"] = summarize(errors)
+
+    # Same replay with the firmware's own probe attached
+    probe = irstats.TimingProbe(
+        daikinremote.SYMBOL_NAMES, daikinremote.SYMBOL_DURATIONS
+    )
+    probed = irbackend.PWMBackend(13, probe)
+    probed.send(train)
+    result["pwm_probe"] = probe.summary()
+    check(
+        "pwm_probe_counts_every_symbol",
+        sum(probe.count) == len(train),
+        "{0} of {1} symbols".format(sum(probe.count), len(train)),
+    )
+    return result
+
+
+# Multiple units: transmitter thread feeding several PIO state machines
+
+
+def modulator_word_us(index, word):
+    # Time irbackend's PIO program spends on a word: spaces on even words,
+    # marks (carrier periods) on odd ones
+    if index & 1 == 0:
+        return word + 5
+    return (word + 1) * 26 if word else 1
+
+
+class _PIOInstruction:
+    def __getitem__(self, delay):
+        return self
+
+    def side(self, value):
+        return self
+
+
+def pio_program(program):
+    # Runs the body of an rp2.asm_pio program against a recorder. Returns the
+    # number of instructions, the address of each label and the jump targets.
+    instructions = []
+    labels = {}
+    jumps = []
+
+    def emit(*args):
+        instructions.append(args)
+        return _PIOInstruction()
+
+    def jmp(*args):
+        jumps.append(args[-1])
+        return emit(*args)
+
+    # Operands stand for themselves
+    operands = "x y osr isr pins pin null pindirs status not_x not_y x_dec y_dec"
+    operands += " x_not_y not_osre block noblock clear rel"
+    names = {name: name for name in operands.split()}
+    names.update(
+        label=lambda name: labels.__setitem__(name, len(instructions)),
+        jmp=jmp,
+        wrap_target=lambda: None,
+        wrap=lambda: None,
+    )
+    for name in ("pull", "push", "mov", "set", "out", "in_", "wait", "nop", "irq"):
+        names[name] = emit
+    types.FunctionType(program.__code__, names)()
+    return len(instructions), labels, jumps
+
+
+def run_units(pins, commands):
+    # Sends commands states through one channel per pin, returns commands/s
+    daikinremote.channels[:] = []
+    channels = [
+        daikinremote.add_channel(irbackend.PIOBackend(pin, i))
+        for i, pin in enumerate(pins)
+    ]
+    remaining = [commands] * len(channels)
+    done = []
+
+    start = time.perf_counter()
+    while len(done) < commands * len(channels):
+        for i, channel in enumerate(channels):
+            if remaining[i] and not channel.busy():
+                remaining[i] -= 1
+                channel.send_async(*ALL_STATES[i], callback=done.append)
+        daikinremote.poll_send()
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    words = [len(channel.backend._sm.words) for channel in channels]
+    daikinremote.channels[:] = []
+    return {
+        "units": len(channels),
+        "commands": len(done),
+        "errors": len([error for error in done if error is not None]),
+        "elapsed_s": round(elapsed, 3),
+        "commands_per_s": round(len(done) / elapsed, 2),
+        "words_per_unit": words,
+    }
+
+
+def bench_units(quick):
+    commands = 1 if quick else 3
+    rp2.StateMachine.word_us = modulator_word_us
+    try:
+        result = {
+            "1_unit": run_units([13], commands),
+            "2_units": run_units([13, 14], commands),
+            "4_units": run_units([13, 14, 15, 16], commands),
+            "2_units_shared_pin": run_units([13, 13], commands),
+        }
+    finally:
+        rp2.StateMachine.word_us = None
+
+    single = result["1_unit"]["commands_per_s"]
+    speedup = result["4_units"]["commands_per_s"] / single
+    result["4_units_speedup"] = round(speedup, 2)
+    check("units_transmit_in_parallel", speedup > 2.5, round(speedup, 2))
+
+    shared = result["2_units_shared_pin"]["commands_per_s"] / single
+    check("units_sharing_a_pin_serialize", shared < 1.2, round(shared, 2))
+
+    # The shim doesn't assemble programs: a label after the last instruction
+    # would jump out of the program on the RP2040
+    size, labels, jumps = pio_program(irbackend._ir_modulator)
+    outside = [jump for jump in jumps if labels.get(jump, size) >= size]
+    check("pio_jumps_within_program", not outside, outside)
+    return result
+
+
+# Command path: MQTT message, dispatch, coalescing timer, IR, confirmation
+
+
+def bench_command(quick):
+    commands = 50 if quick else 500
+    client_sock, broker = socket.socketpair()
+    cwd = os.getcwd()
+    tmp = tempfile.TemporaryDirectory()
+    os.chdir(tmp.name)
+    daikinremote.channels[:] = []
+    threads = []
+    start_new_thread = daikinremote._thread.start_new_thread
+
+    try:
+        # The real handlers: ClimateUnit, coalescing timer, IR, then the QoS 1
+        # confirmation from state_sent() and its PUBACK
+        main = host.load_main(COALESCE_MS=0)
+        client = main.c
+        client.sock = usocket.StreamSocket(client_sock)
+        client.set_callback(main.process_message)
+        main.ONLINE = True
+        # Flash writes are deferred past the run, they are not part of the path
+        main.STATE_WRITE_DELAY_MS = 1 << 29
+        unit = main.units[0]
+        unit.state.update(main.DEFAULT_STATE)
+        unit.state.update({"power": "on", "mode": "cool"})
+
+        packets = [
+            publish_packet(unit.temperature_command_topic, value)
+            for value in (b"22", b"21")
+        ]
+        confirmation = bytearray(256)
+        puback = bytearray(b"\x40\x02\0\0")
+        count = [0]
+
+        def command():
+            broker.sendall(packets[count[0] & 1])
+            count[0] += 1
+            client.wait_msg()
+            main.loop._run_timers(time.ticks_ms())
+            # Lets the transmitter thread run, then completes the send
+            while daikinremote.BLASTING:
+                time.sleep(0)
+            main.poll_send()
+
+            acknowledge(broker, client, confirmation, puback)
+
+        # The first commands warm the caches and start the transmitter thread
+        for _ in range(4):
+            command()
+
+        def counting_start(function, args):
+            threads.append(function)
+            return start_new_thread(function, args)
+
+        daikinremote._thread.start_new_thread = counting_start
+        result = {"command": timed(command, commands)}
+        allocated = allocations(command, 50)
+
+        # A flash write during the send waits for its completion
+        broker.sendall(packets[count[0] & 1])
+        client.wait_msg()
+        main.loop._run_timers(time.ticks_ms())
+        main.save_schedule()
+        main.save_discovery_hash()
+        paths = (main.SCHEDULE_PATH, main.DISCOVERY_HASH_PATH)
+        deferred = not any(os.path.exists(path) for path in paths)
+        while daikinremote.BLASTING:
+            time.sleep(0)
+        main.poll_send()
+        acknowledge(broker, client, confirmation, puback)
+        later = time.ticks_add(time.ticks_ms(), main.FLASH_WRITE_RETRY_MS)
+        main.loop._run_timers(later)
+        written = all(os.path.exists(path) for path in paths)
+        result["inflight"] = client.inflight
+    finally:
+        daikinremote._thread.start_new_thread = start_new_thread
+        daikinremote.channels[:] = []
+        client_sock.close()
+        broker.close()
+        os.chdir(cwd)
+        tmp.cleanup()
+
+    result["allocations"] = allocated
+    result["threads_started"] = len(threads)
+    check("command_path_allocation_free", not allocated, allocated)
+    check("command_path_reuses_transmitter", not threads, len(threads))
+    check("command_confirmations_acknowledged", not result["inflight"], result["inflight"])
+    check("flash_write_waits_for_send", deferred and written, [deferred, written])
+    return result
+
+
+# State publishing
+
+
+def bench_state(quick):
+    repeat = 500 if quick else 5000
+    client_sock, broker = socket.socketpair()
+    cwd = os.getcwd()
+    tmp = tempfile.TemporaryDirectory()
+    os.chdir(tmp.name)
+    daikinremote.channels[:] = []
+
+    try:
+        # The QoS 1 publishes of state_sent(), with their PUBACKs
+        main = host.load_main(JSON_STATE=True)
+        client = main.c
+        client.sock = usocket.StreamSocket(client_sock)
+        client.set_callback(main.process_message)
+        unit = main.units[0]
+        unit.state.update(main.DEFAULT_STATE)
+        unit.state["power"] = "on"
+        # Every field changes between two states, nothing is suppressed
+        states = (
+            {"mode": "cool", "fan_mode": "Auto", "temperature": "21.0"},
+            {"mode": "heat", "fan_mode": "Quiet", "temperature": "22.0"},
+        )
+        received = bytearray(1024)
+        puback = bytearray(b"\x40\x02\0\0")
+        count = [0]
+        sent = {}
+
+        def publish_json():
+            unit.state.update(states[count[0] & 1])
+            count[0] += 1
+            unit.publish_json_state()
+            sent["json"] = acknowledge(broker, client, received, puback)
+
+        def publish_fields():
+            unit.state.update(states[count[0] & 1])
+            count[0] += 1
+            client.begin_batch()
+            unit.publish_fields(0b111)
+            client.flush()
+            sent["fields"] = acknowledge(broker, client, received, puback)
+
+        result = {
+            "publish_json": timed(publish_json, repeat),
+            "publish_fields": timed(publish_fields, repeat),
+        }
+        allocated = allocations(publish_json, 100)
+        result["inflight"] = client.inflight
+    finally:
+        daikinremote.channels[:] = []
+        client_sock.close()
+        broker.close()
+        os.chdir(cwd)
+        tmp.cleanup()
+
+    result["bytes_json"] = sent["json"]
+    result["bytes_fields"] = sent["fields"]
+    result["allocations"] = allocated
+    check("json_state_allocation_free", not allocated, allocated)
+    check("state_publishes_acknowledged", not result["inflight"], result["inflight"])
+    return result
+
+
+# Captured frames
+
+
+def bench_corpus(quick):
+    with open(corpus.CAPTURE_PATH) as f:
+        text = f.read()
+
+    start = time.perf_counter()
+    data, skipped = corpus.parse_capture(text)
+    parse_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    mismatches = corpus.verify(data)
+    verify_ms = (time.perf_counter() - start) * 1000
+
+    records = len(data) // corpus.RECORD_SIZE
+
+    # The captured states double as encoder input
+    captured = [
+        daikinencoder.get_frames(
+            bytearray(data[i * corpus.RECORD_SIZE + 4 : (i + 1) * corpus.RECORD_SIZE])
+        )
+        for i in range(records)
+    ]
+    train = irbackend.array("H", [0] * daikinremote.PULSE_TRAIN_SIZE)
+    frames = iter(captured * (20 if quick else 200))
+
+    check(
+        "encoder_matches_captures",
+        records and not mismatches,
+        mismatches[:8] if mismatches else records,
+    )
+    return {
+        "records": records,
+        "bytes": len(data),
+        "skipped_labels": len(skipped),
+        "parse_ms": round(parse_ms, 3),
+        "verify_ms": round(verify_ms, 3),
+        "verify_us_per_record": round(verify_ms * 1000 / records, 3) if records else 0,
+        "encode_pulse_train": timed(
+            lambda: daikinremote.encode_pulse_train(next(frames), train),
+            records * (20 if quick else 200),
+        ),
+    }
+
+
+# Schedule
+
+
+def bench_schedule(quick):
+    week = scheduler.MINUTES_PER_WEEK
+    start = scheduler.epoch_minute(1700000000)
+
+    # Every day at 07:30, Monday at 00:00 and Sunday at 23:59, plus one-shots
+    weekly = [day * 1440 + 450 for day in range(7)] + [0, week - 1]
+    once = [start + 1, start + 63, start + 64, start + 65, start + 5000]
+    fired = []
+    wheel = scheduler.Scheduler(lambda action: fired.append((wheel.minute, action)))
+    wheel.start(start)
+    for i in range(len(weekly)):
+        wheel.add_weekly(weekly[i], i)
+    for i in range(len(once)):
+        wheel.add_once(once[i], 100 + i)
+    stale = wheel.add_once(start, 200)
+    too_far = wheel.add_once(start + scheduler.MAX_DELAY + 1, 201)
+
+    end = start + 2 * week + 10
+    wheel.tick(end)
+    expected = [
+        (minute, i)
+        for minute in range(start + 1, end + 1)
+        for i in range(len(weekly))
+        if scheduler.minute_of_week(minute) == weekly[i]
+    ] + [(once[i], 100 + i) for i in range(len(once))]
+    check(
+        "schedule_fires_on_time",
+        sorted(fired) == sorted(expected)
+        and not stale
+        and not too_far
+        and wheel.count == len(weekly),
+        {"fired": len(fired), "expected": len(expected)},
+    )
+
+    # A tick only walks its slot: cost per minute with few and many entries
+    ticks = 2000 if quick else 20000
+
+    def tick_cost(entries):
+        wheel = scheduler.Scheduler(lambda action: None)
+        wheel.start(start)
+        for i in range(entries):
+            wheel.add_weekly((i * 157) % week, i)
+        minute = [start]
+
+        def tick():
+            minute[0] += 1
+            wheel.tick(minute[0])
+
+        return timed(tick, ticks)
+
+    # Frame 2 of a cached state follows the clock
+    daikinremote.set_clock(615, 3)
+    cache = daikinremote.StateCache(2)
+    key = daikinremote.state_key("on", "cool", 21, "Auto")
+    train = cache.get(key)
+    fields = corpus.fields_of(cache.state_raw(key))
+    expected_train = daikinremote.encode_pulse_train(
+        daikinencoder.get_frames(cache.state_raw(key))
+    )
+    daikinremote.set_clock(-1, 0)
+    check(
+        "frame_2_follows_clock",
+        fields.Time == 615
+        and fields.DayOfWeek == 3
+        and list(train) == list(expected_train),
+        {"time": fields.Time, "day": fields.DayOfWeek},
+    )
+
+    # A clock sync rebuilding the wheel before the tick processed the new
+    # minute: entries due that minute still fire
+    cwd = os.getcwd()
+    tmp = tempfile.TemporaryDirectory()
+    os.chdir(tmp.name)
+    daikinremote.channels[:] = []
+    try:
+        main = host.load_main()
+        main.load_state()
+        main.CLOCK_SYNCED = True
+        base = int(main.local_minute())
+        main.epoch_minute = lambda: base - main.UTC_OFFSET_MINUTES
+        main.apply_schedule()
+        week_minute = main.minute_of_week(base + 1)
+        main.SCHEDULE = {"once": [{"due": base + 1, "fan_mode": "3"}]}
+        main.SCHEDULE_ENTRIES = [
+            (week_minute, main.schedule_action({"mode": "heat"}), True),
+            (base + 1, main.schedule_action({"fan_mode": "3"}), False),
+        ]
+        main.epoch_minute = lambda: base + 1 - main.UTC_OFFSET_MINUTES
+        main.apply_schedule()
+        main.tick_schedule()
+        rebuilt = main.scheduler.fired
+    finally:
+        daikinremote.channels[:] = []
+        daikinremote.set_clock(-1, 0)
+        os.chdir(cwd)
+        tmp.cleanup()
+    check("schedule_rebuild_keeps_due_minute", rebuilt == 2, rebuilt)
+
+    return {
+        "fired": len(fired),
+        "tick_2_entries": tick_cost(2),
+        "tick_64_entries": tick_cost(64),
+    }
+
+
+# Decoder
+
+
+def synthetic_edges(states):
+    edges = []
+    ticks = 1000
+    for state in states:
+        train = daikinremote.encode_pulse_train(
+            daikinencoder.get_frames(daikinremote.prepare_state(*state))
+        )
+        for i in range(len(train)):
+            # Receiver output is active low
+            edges.append((ticks & 0x3FFFFFFE) | (0 if i & 1 else 1))
+            ticks += train[i]
+        edges.append((ticks & 0x3FFFFFFE) | 0)
+        ticks += daikinremote._BIT_MARK
+        edges.append((ticks & 0x3FFFFFFE) | 1)
+        ticks += 100000
+    return edges
+
+
+def bench_decoder(quick):
+    states = ALL_STATES[:: 97 if quick else 13]
+    edges = synthetic_edges(states)
+    decoded = []
+    decoder = daikindecoder.FrameDecoder(lambda *state: decoded.append(state))
+
+    start = time.perf_counter()
+    for edge in edges:
+        decoder.feed(edge)
+    elapsed = time.perf_counter() - start
+
+    check("decoder_decodes_every_state", len(decoded) == len(states), len(decoded))
+    return {
+        "transmissions": len(states),
+        "edges": len(edges),
+        "edges_per_s": round(len(edges) / elapsed, 1),
+        "us_per_transmission": round(elapsed * 1e6 / len(states), 3),
+        "errors": decoder.errors,
+    }
+
+
+# Calibration
+
+
+class LoopbackReceiver:
+    """Emitter and receiver facing each other, for ircalib.Calibration.
+
+    send() turns a train into the edges a receiver would capture: marks
+    rounded to whole carrier periods (as with the PIO backend) then
+    stretched by skew_us, spaces shortened by as much. The first drops
+    sends lose an edge. The capture side has the EdgeCapture interface.
+    """
+
+    def __init__(self, skew_us, drops=0):
+        self.skew_us = skew_us
+        self.drops = drops
+        self.edges = []
+        self.ticks = 1000
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def read(self):
+        return self.edges.pop(0) if self.edges else -1
+
+    def drain_into(self, buf, n):
+        while n < len(buf) and self.edges:
+            buf[n] = self.edges.pop(0)
+            n += 1
+        return n
+
+    def send(self, train):
+        # The line is idle high, the first space has no edge
+        ticks = self.ticks + train[0]
+        for i in range(1, len(train)):
+            self.edges.append((ticks & 0x3FFFFFFE) | (0 if i & 1 else 1))
+            if i & 1:
+                ticks += (train[i] + 13) // 26 * 26 + self.skew_us
+            else:
+                ticks += train[i] - self.skew_us
+        self.ticks = ticks + 100000
+
+        if self.drops:
+            self.drops -= 1
+            del self.edges[100]
+
+
+def bench_calibration(quick):
+    receiver = LoopbackReceiver(60, drops=1)
+    calibration = ircalib.Calibration(receiver, receiver)
+    raw = daikinremote.prepare_state("on", "cool", 21, "Auto")
+
+    start = time.perf_counter()
+    ok = calibration.run(raw)
+    elapsed = time.perf_counter() - start
+
+    errors = list(calibration.errors)
+    check(
+        "calibration_converges",
+        ok
+        and calibration.mismatches == 1
+        and max(abs(error) for error in errors) <= calibration.tolerance_us,
+        {"rounds": calibration.rounds, "errors": errors},
+    )
+
+    # Installed timings reach every cached train, unchanged frames included
+    daikinremote.channels[:] = []
+    channel = daikinremote.add_channel(irbackend.RecordingBackend())
+    key = daikinremote.state_key("on", "cool", 21, "Auto")
+    channel.state_cache.get(key)
+    daikinremote.set_timings(calibration.timings)
+    train = channel.state_cache.get(key)
+    expected = daikinremote.encode_pulse_train(
+        daikinencoder.get_frames(channel.state_cache.state_raw(key))
+    )
+    daikinremote.set_timings(daikinremote.SYMBOL_DURATIONS)
+    daikinremote.channels[:] = []
+    check(
+        "calibrated_timings_reencode_cache",
+        list(train) == list(expected) and train[1] == calibration.timings[0],
+        list(calibration.timings),
+    )
+
+    return {
+        "rounds": calibration.rounds,
+        "mismatches": calibration.mismatches,
+        "ms": round(elapsed * 1000, 3),
+        "timings": dict(zip(daikinremote.SYMBOL_NAMES, calibration.timings)),
+        "errors_us": dict(zip(daikinremote.SYMBOL_NAMES, errors)),
+    }
+
+
+# MQTT
+
+
+def publish_packet(topic, msg):
+    body = len(topic).to_bytes(2, "big") + topic + msg
+    return bytes([0x30, len(body)]) + body
+
+
+def drain(sock):
+    sock.setblocking(False)
+    try:
+        while sock.recv(65536):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def acknowledge(broker, client, received, puback):
+    # Reads what the client sent, acknowledges each QoS 1 PUBLISH in it and
+    # has the client process the PUBACKs. Returns the bytes read.
+    n = broker.recv_into(received)
+    acks = 0
+    i = 0
+    while i < n:
+        header = received[i]
+        size = 0
+        shift = 0
+        i += 1
+        while True:
+            byte = received[i]
+            i += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        if header & 0xF6 == 0x32:
+            # The packet id follows the topic
+            pid = i + 2 + (received[i] << 8 | received[i + 1])
+            puback[2] = received[pid]
+            puback[3] = received[pid + 1]
+            broker.sendall(puback)
+            acks += 1
+        i += size
+    for _ in range(acks):
+        client.wait_msg()
+    return n
+
+
+def bench_mqtt(quick):
+    repeat = 2000 if quick else 20000
+    client_sock, broker = socket.socketpair()
+    client = simple.MQTTClient("bench", "localhost")
+    client.sock = usocket.StreamSocket(client_sock)
+
+    topic = b"glavoie84/pico-daikin-remote_bench/temperature"
+    count = [0]
+
+    def publish():
+        client.publish(topic, b"21.0", True)
+        count[0] += 1
+        if count[0] % 64 == 0:
+            drain(broker)
+
+    result = {"publish": timed(publish, repeat)}
+    result["publish"]["writes_per_publish"] = client.sock.writes / repeat
+    drain(broker)
+
+    # Parse: the broker side pushes PUBLISH packets, the client reads them
+    packets = [
+        publish_packet(b"glavoie84/pico-daikin-remote_bench/mode/set", b"cool"),
+        publish_packet(b"glavoie84/pico-daikin-remote_bench/temperature/set", b"23.0"),
+    ]
+    table = dispatch.TopicTable()
+    table.add(b"glavoie84/pico-daikin-remote_bench/mode/set", lambda msg: None)
+    table.add(b"glavoie84/pico-daikin-remote_bench/temperature/set", lambda msg: None)
+    client.set_callback(lambda t, m: table.lookup(t)(m))
+
+    broker.setblocking(True)
+    batch = b"".join(packets * 256)
+
+    def fill():
+        broker.sendall(batch)
+
+    def receive():
+        for _ in range(len(packets) * 256):
+            client.wait_msg()
+
+    parse_repeat = 4 if quick else 40
+    start = time.perf_counter()
+    for _ in range(parse_repeat):
+        fill()
+        receive()
+    elapsed = time.perf_counter() - start
+    messages = parse_repeat * len(packets) * 256
+    result["receive_dispatch"] = {
+        "messages": messages,
+        "us_per_message": round(elapsed * 1e6 / messages, 3),
+        "messages_per_s": round(messages / elapsed, 1),
+    }
+
+    # Steady-state receiving must not allocate (first pass warms the caches)
+    def fill_receive():
+        fill()
+        receive()
+
+    allocated = allocations(fill_receive, 1)
+    result["receive_dispatch"]["allocations"] = allocated
+    check("mqtt_receive_allocation_free", not allocated, allocated)
+
+    # QoS 1: publishes go out without waiting, PUBACKs are matched as they
+    # arrive and an overdue packet is sent again with DUP
+    drain(broker)
+    start = time.perf_counter()
+    pids = [client.publish(topic, b"22.0", True, 1) for _ in range(client.max_inflight)]
+    pipelined_us = (time.perf_counter() - start) * 1e6 / len(pids)
+    depth = client.inflight
+    drain(broker)
+
+    client.retry_ms = 0
+    client.resend_expired()
+    broker.setblocking(True)
+    resent = broker.recv(65536)
+    size = len(resent) // len(pids)
+    dup = len(resent) == size * len(pids) and all(
+        resent[i * size] == 0x3B for i in range(len(pids))
+    )
+
+    for pid in pids:
+        broker.sendall(bytes([0x40, 2, pid >> 8, pid & 0xFF]))
+    for _ in pids:
+        client.wait_msg()
+    result["qos1"] = {
+        "us_per_publish": round(pipelined_us, 3),
+        "inflight_depth": depth,
+        "inflight_max": client.inflight_max,
+        "retries": client.retries,
+        "inflight_after_acks": client.inflight,
+    }
+    check(
+        "mqtt_qos1_pipelined",
+        depth == len(pids) and client.inflight == 0,
+        result["qos1"],
+    )
+    check("mqtt_qos1_retransmits_with_dup", dup and client.retries == len(pids), dup)
+
+    # Session setup: every command topic in one SUBSCRIBE, one multi-entry SUBACK
+    drain(broker)
+    topics = [
+        b"glavoie84/pico-daikin-remote_bench/fan_mode/set",
+        b"glavoie84/pico-daikin-remote_bench/mode/set",
+        b"glavoie84/pico-daikin-remote_bench/temperature/set",
+    ]
+    pid = client.pid + 1
+    broker.sendall(bytes([0x90, 2 + len(topics), pid >> 8, pid & 0xFF]) + bytes(3))
+    writes = client.sock.writes
+    client.subscribe(topics)
+    check(
+        "mqtt_subscribe_single_packet",
+        client.sock.writes - writes == 1,
+        client.sock.writes - writes,
+    )
+
+    # A broker that never answers: the waits give up after ping_timeout_ms
+    client.ping_timeout_ms = 50
+    client.publish(b"bench/ack", b"1", False, 1)
+    timeouts = []
+    for wait in (client.wait_acks, lambda: client.subscribe(topics)):
+        drain(broker)
+        start = time.perf_counter()
+        try:
+            wait()
+        except OSError:
+            timeouts.append(round((time.perf_counter() - start) * 1000))
+
+    # Nor does a broker accepting the connection without a CONNACK block
+    # connect(), and the watchdog hook runs before every step
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    silent = simple.MQTTClient(
+        "bench", "127.0.0.1", server.getsockname()[1], ping_timeout_ms=50
+    )
+    hooks = []
+    silent.on_wait = lambda: hooks.append(1)
+    start = time.perf_counter()
+    try:
+        silent.connect()
+    except OSError:
+        timeouts.append(round((time.perf_counter() - start) * 1000))
+    silent.sock.close()
+    server.close()
+    result["wait_timeouts_ms"] = timeouts
+    check("mqtt_waits_time_out", len(timeouts) == 3 and len(hooks) == 3, timeouts)
+
+    # Reconnect backoff: exponential, capped, half jittered
+    backoff = robust.MQTTClient.__new__(robust.MQTTClient)
+    delays = []
+    sleep_ms = robust.utime.sleep_ms
+    robust.utime.sleep_ms = delays.append
+    try:
+        for i in range(1, 12):
+            backoff.delay(i)
+    finally:
+        robust.utime.sleep_ms = sleep_ms
+    result["reconnect_backoff_ms"] = delays
+    check(
+        "mqtt_backoff_capped",
+        delays[0] <= robust.MQTTClient.DELAY_MS
+        and max(delays) <= robust.MQTTClient.MAX_DELAY_MS
+        and delays[-1] >= robust.MQTTClient.MAX_DELAY_MS // 2,
+        delays,
+    )
+
+    client_sock.close()
+    broker.close()
+
+    publishes = failed_publish()
+    result["failed_publish_resent"] = publishes
+    check(
+        "mqtt_failed_publish_sent_once",
+        publishes == [(2, False), (1, True)],
+        publishes,
+    )
+    return result
+
+
+class _BrokenSocket:
+    def write(self, buf, n=None):
+        raise OSError(104)
+
+    def close(self):
+        pass
+
+
+class _RefusedOnceClient(robust.MQTTClient):
+    # Gives up after one failed connect, like main.py, and the first connect
+    # is refused: the failure reaches publish(), which reconnects again
+    MAX_ATTEMPTS = 1
+
+    def log(self, in_reconnect, e):
+        if in_reconnect:
+            self.port = self.next_port
+
+
+def failed_publish():
+    # A QoS 1 publish whose socket write fails, with an earlier one still in
+    # flight. Returns (pid, DUP) of each PUBLISH the broker gets after the
+    # reconnect: the failed one once, then the earlier one again.
+    refused = socket.socket()
+    refused.bind(("127.0.0.1", 0))
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    received = bytearray()
+
+    def serve():
+        conn, _ = server.accept()
+        conn.recv(256)
+        conn.sendall(b"\x20\x02\x01\x00")
+        conn.settimeout(0.5)
+        try:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                received.extend(data)
+        except socket.timeout:
+            pass
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    client_sock, broker = socket.socketpair()
+    client = _RefusedOnceClient("bench", "127.0.0.1", port=refused.getsockname()[1])
+    client.next_port = server.getsockname()[1]
+    client.sock = usocket.StreamSocket(client_sock)
+    client.publish(b"bench/a", b"1", False, 1)
+    client.sock = _BrokenSocket()
+    client.publish(b"bench/b", b"2", False, 1)
+    thread.join()
+    client.sock.close()
+    client_sock.close()
+    broker.close()
+    refused.close()
+    server.close()
+
+    publishes = []
+    i = 0
+    while i < len(received):
+        header = received[i]
+        size = received[i + 1]
+        if header & 0xF0 == 0x30:
+            pid = i + 4 + (received[i + 2] << 8 | received[i + 3])
+            dup = bool(header & 0x08)
+            publishes.append((received[pid] << 8 | received[pid + 1], dup))
+        i += 2 + size
+    return publishes
+
+
+# Main loop latency: sleep polling versus the poll based event loop
+
+
+def run_sender(sock, delays, sent):
+    for delay in delays:
+        time.sleep(delay)
+        sent.append(time.perf_counter())
+        sock.send(b"x")
+
+
+def bench_latency(quick):
+    commands = 8 if quick else 25
+    rng = random.Random(1)
+    delays = [rng.uniform(0.02, 0.15) for _ in range(commands)]
+    result = {}
+
+    # Previous main loop: sleep 100 ms, then check for a message
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    sent, received = [], []
+    sender = threading.Thread(target=run_sender, args=(b, delays, sent))
+    sender.start()
+    while len(received) < commands:
+        time.sleep(0.1)
+        try:
+            for _ in a.recv(64):
+                received.append(time.perf_counter())
+        except BlockingIOError:
+            pass
+    sender.join()
+    result["sleep_poll_ms"] = summarize(
+        [round((r - s) * 1000, 3) for s, r in zip(sent, received)]
+    )
+    a.close()
+    b.close()
+
+    # Event loop: woken by the socket becoming readable
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    sent, received = [], []
+    loop = eventloop.EventLoop()
+
+    def readable():
+        for _ in a.recv(64):
+            received.append(time.perf_counter())
+        if len(received) >= commands:
+            loop.stop()
+
+    loop.add_reader(a, readable)
+    sender = threading.Thread(target=run_sender, args=(b, delays, sent))
+    sender.start()
+    loop.run()
+    sender.join()
+    result["event_loop_ms"] = summarize(
+        [round((r - s) * 1000, 3) for s, r in zip(sent, received)]
+    )
+    a.close()
+    b.close()
+    return result
+
+
+# Persistence
+
+
+def bench_persistence(quick):
+    rng = random.Random(2)
+    commands = 100 if quick else 1000
+    packed = [rng.choice((0x1503, 0x1603, 0x1703, 0x1713)) for _ in range(commands)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Previous behaviour: one JSON rewrite per command
+        path = os.path.join(tmp, "state.json")
+        state = {"power": "on", "mode": "cool", "fan_mode": "Auto", "temperature": "21.0"}
+        for _ in packed:
+            with open(path, "w") as f:
+                json.dump(state, f)
+        start = time.perf_counter()
+        with open(path) as f:
+            json.load(f)
+        json_load_us = (time.perf_counter() - start) * 1e6
+
+        # Journal: bursts of 4 commands flushed once, unchanged states skipped
+        journal = statestore.StateJournal(os.path.join(tmp, "state.bin"))
+        for i, value in enumerate(packed):
+            journal.save(value)
+            if i % 4 == 3:
+                journal.flush()
+        journal.flush()
+
+        loaded = statestore.StateJournal(os.path.join(tmp, "state.bin"))
+        last = loaded.load()
+
+    check("journal_loads_last_state", last == packed[-1], last)
+    return {
+        "commands": commands,
+        "json_flash_writes": commands,
+        "json_load_us": round(json_load_us, 3),
+        "journal_flash_writes": journal.writes,
+        "journal_skipped_saves": journal.skipped,
+        "journal_load_us": loaded.load_us,
+    }
+
+
+BENCHMARKS = {
+    "encode": bench_encode,
+    "blast": bench_blast,
+    "units": bench_units,
+    "command": bench_command,
+    "state": bench_state,
+    "corpus": bench_corpus,
+    "schedule": bench_schedule,
+    "decoder": bench_decoder,
+    "calibration": bench_calibration,
+    "mqtt": bench_mqtt,
+    "latency": bench_latency,
+    "persistence": bench_persistence,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--only", default="", help="comma separated benchmark names")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations")
+    args = parser.parse_args(argv)
+
+    names = [name for name in args.only.split(",") if name] or list(BENCHMARKS)
+    results = {}
+    for name in names:
+        print("Running {0}...".format(name))
+        results[name] = BENCHMARKS[name](args.quick)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "quick": args.quick,
+        },
+        "results": results,
+        "checks": CHECKS,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+    failed = [name for name, result in CHECKS.items() if not result["ok"]]
+    for name in failed:
+        print("Check failed: {0} ({1})".format(name, CHECKS[name]["detail"]))
+    print("Results written to " + args.output)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
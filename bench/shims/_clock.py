@@ -0,0 +1,58 @@
+"""MicroPython ``time`` extensions grafted onto CPython's ``time`` module.
+
+``ticks_*`` values wrap like the device's 30-bit tick counters so
+``ticks_diff``/``ticks_add`` arithmetic behaves the same on the host.
+"""
+
+import time
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD // 2
+
+
+def ticks_us():
+    return (time.perf_counter_ns() // 1000) & _TICKS_MAX
+
+
+def ticks_ms():
+    return (time.perf_counter_ns() // 1000000) & _TICKS_MAX
+
+
+def ticks_cpu():
+    return time.perf_counter_ns() & _TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(end, start):
+    return ((end - start + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+
+def sleep_us(us):
+    if us > 0:
+        time.sleep(us / 1000000)
+
+
+def sleep_ms(ms):
+    if ms > 0:
+        time.sleep(ms / 1000)
+
+
+def install():
+    for name in (
+        "ticks_us",
+        "ticks_ms",
+        "ticks_cpu",
+        "ticks_add",
+        "ticks_diff",
+        "sleep_us",
+        "sleep_ms",
+    ):
+        if not hasattr(time, name):
+            setattr(time, name, globals()[name])
+
+
+install()
@@ -0,0 +1,27 @@
+"""MicroPython ``gc`` extensions grafted onto CPython's ``gc`` module.
+
+``mem_alloc`` reports the memory traced by ``tracemalloc`` (0 while it
+isn't tracing) and ``mem_free`` the rest of an RP2040 sized heap.
+"""
+
+import gc
+import tracemalloc
+
+HEAP_SIZE = 192 * 1024
+
+
+def mem_alloc():
+    return tracemalloc.get_traced_memory()[0]
+
+
+def mem_free():
+    return max(HEAP_SIZE - mem_alloc(), 0)
+
+
+def install():
+    for name in ("mem_alloc", "mem_free"):
+        if not hasattr(gc, name):
+            setattr(gc, name, globals()[name])
+
+
+install()
@@ -0,0 +1,20 @@
+"""Stand-in for ``_thread`` backed by CPython's own threads.
+
+The firmware starts a single transmitter thread that parks on a lock
+between transmissions, so it has to run next to the main thread rather
+than inline.
+
+CPython's own ``_thread`` is built in, so bench.host installs this module
+in ``sys.modules`` instead of relying on the import path.
+"""
+
+import _thread as _host
+
+LockType = _host.LockType
+allocate_lock = _host.allocate_lock
+get_ident = _host.get_ident
+start_new_thread = _host.start_new_thread
+
+
+def exit():
+    raise SystemExit
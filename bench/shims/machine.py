@@ -0,0 +1,131 @@
+"""CPython stand-in for the parts of ``machine`` this project uses.
+
+``PWM`` keeps a log of ``(ticks_us, duty)`` writes so carrier on/off
+timing can be inspected after a transmission.
+"""
+
+import _clock  # noqa: F401
+import time
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self._value = 0 if value is None else value
+        self.handler = None
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if mode != -1:
+            self.mode = mode
+        if value is not None:
+            self._value = value
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value ^= 1
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self.handler = handler
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+
+class PWM:
+    def __init__(self, pin, freq=0, duty_u16=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty_u16
+        self.log = []
+        self.recording = False
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+        if self.recording:
+            self.log.append((time.ticks_us(), value))
+
+    def deinit(self):
+        self._duty = 0
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self.callback = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=-1, period=-1, callback=None):
+        self.mode = mode
+        self.period = period
+        self.callback = callback
+
+    def deinit(self):
+        self.callback = None
+
+    def fire(self):
+        if self.callback is not None:
+            self.callback(self)
+
+
+class WDT:
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.feeds = 0
+
+    def feed(self):
+        self.feeds += 1
+
+
+class RTC:
+    def datetime(self, value=None):
+        if value is None:
+            t = time.localtime()
+            return (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
+
+
+def unique_id():
+    return b"\xe6\x61\x41\x04\x03\x2b\x2c\x2a"
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+def freq(value=None):
+    return 125000000
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state=0):
+    pass
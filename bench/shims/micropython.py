@@ -0,0 +1,26 @@
+"""CPython stand-in for the ``micropython`` module."""
+
+
+def const(value):
+    return value
+
+
+def native(f):
+    return f
+
+
+def viper(f):
+    return f
+
+
+def schedule(f, arg):
+    f(arg)
+    return True
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def mem_info(verbose=False):
+    pass
@@ -0,0 +1,42 @@
+"""CPython stand-in for ``network``: a WLAN that is always connected."""
+
+STA_IF = 0
+AP_IF = 1
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self._active = False
+        self._status = STAT_IDLE
+        self._ifconfig = ("192.168.0.50", "255.255.255.0", "192.168.0.1", "192.168.0.1")
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = bool(value)
+
+    def connect(self, ssid=None, key=None, bssid=None):
+        self._status = STAT_GOT_IP
+
+    def disconnect(self):
+        self._status = STAT_IDLE
+
+    def isconnected(self):
+        return self._status == STAT_GOT_IP
+
+    def status(self, param=None):
+        return self._status
+
+    def ifconfig(self, value=None):
+        if value is None:
+            return self._ifconfig
+        self._ifconfig = value
+
+    def scan(self):
+        return []
+
+    def config(self, *args, **kwargs):
+        return None
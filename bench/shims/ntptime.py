@@ -0,0 +1,8 @@
+"""CPython stand-in for ``ntptime``: the host clock is set already."""
+
+host = "pool.ntp.org"
+timeout = 1
+
+
+def settime():
+    pass
@@ -0,0 +1,89 @@
+"""CPython stand-in for ``rp2``: PIO programs are not assembled, and state
+machines record every word pushed into their TX FIFO.
+
+With ``StateMachine.word_us`` set, the TX FIFO also drains in real time:
+``word_us(index, word)`` returns how long the program spends on the
+index-th word it pulls, ``put()`` blocks while the FIFO is full and
+``tx_fifo()`` counts the words not pulled yet.
+"""
+
+import collections
+import time
+
+
+class PIO:
+    OUT_LOW = 0
+    OUT_HIGH = 1
+    IN_LOW = 0
+    IN_HIGH = 1
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+    JOIN_NONE = 0
+    JOIN_TX = 1
+    JOIN_RX = 2
+    IRQ_SM0 = 0x100
+
+    def __init__(self, id):
+        self.id = id
+
+
+def asm_pio(**kwargs):
+    def wrap(f):
+        f.pio_kwargs = kwargs
+        return f
+
+    return wrap
+
+
+class StateMachine:
+    word_us = None
+
+    def __init__(self, id, prog=None, **kwargs):
+        self.id = id
+        self.prog = prog
+        self.kwargs = kwargs
+        self.words = []
+        self._active = False
+
+        join = getattr(prog, "pio_kwargs", {}).get("fifo_join", PIO.JOIN_NONE)
+        self.fifo_depth = 8 if join == PIO.JOIN_TX else 4
+        self._pulled = 0
+        self._starts = collections.deque()
+        self._busy_until = 0.0
+
+    def init(self, prog=None, **kwargs):
+        self.prog = prog
+        self.kwargs = kwargs
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = bool(value)
+
+    def put(self, value, shift=0):
+        values = [value] if isinstance(value, int) else value
+        for v in values:
+            self._push(v >> shift)
+
+    def _push(self, word):
+        self.words.append(word)
+        if StateMachine.word_us is None:
+            return
+
+        while self.tx_fifo() >= self.fifo_depth:
+            pass
+
+        start = max(time.perf_counter(), self._busy_until)
+        self._busy_until = start + StateMachine.word_us(self._pulled, word) / 1e6
+        self._starts.append(start)
+        self._pulled += 1
+
+    def tx_fifo(self):
+        now = time.perf_counter()
+        starts = self._starts
+        while starts and starts[0] <= now:
+            starts.popleft()
+        return len(starts)
+
+    def rx_fifo(self):
+        return 0
@@ -0,0 +1,116 @@
+"""CPython stand-in for MicroPython's ``uctypes`` module.
+
+Only the subset used by ``daikinencoder`` is implemented: scalar and
+bitfield descriptors, byte arrays, ``addressof`` and ``bytearray_at``.
+Addresses are fake, but offsets from them resolve to the original buffer,
+so views and structs write through exactly like on the device.
+"""
+
+LITTLE_ENDIAN = 0
+BIG_ENDIAN = 1
+NATIVE = 2
+
+_TYPE_SHIFT = 28
+_OFFSET_MASK = 0x1FFFF
+
+UINT8 = 0 << _TYPE_SHIFT
+INT8 = 1 << _TYPE_SHIFT
+UINT16 = 2 << _TYPE_SHIFT
+INT16 = 3 << _TYPE_SHIFT
+UINT32 = 4 << _TYPE_SHIFT
+INT32 = 5 << _TYPE_SHIFT
+BFUINT8 = 8 << _TYPE_SHIFT
+BFINT8 = 9 << _TYPE_SHIFT
+BFUINT16 = 10 << _TYPE_SHIFT
+BFINT16 = 11 << _TYPE_SHIFT
+BFUINT32 = 12 << _TYPE_SHIFT
+BFINT32 = 13 << _TYPE_SHIFT
+
+ARRAY = 1 << 32
+PTR = 2 << 32
+
+BF_POS = 17
+BF_LEN = 22
+
+_SIZES = {0: 1, 1: 1, 2: 2, 3: 2, 4: 4, 5: 4, 8: 1, 9: 1, 10: 2, 11: 2, 12: 4, 13: 4}
+
+_BASE = 0x20000000
+_STRIDE = 0x100000
+_buffers = {}
+_bases = {}
+
+
+def addressof(obj):
+    key = id(obj)
+    if key not in _bases:
+        base = _BASE + len(_buffers) * _STRIDE
+        _bases[key] = base
+        _buffers[base] = obj
+    return _bases[key]
+
+
+def _resolve(addr):
+    base = _BASE + ((addr - _BASE) // _STRIDE) * _STRIDE
+    return _buffers[base], addr - base
+
+
+def bytearray_at(addr, size):
+    buf, offset = _resolve(addr)
+    return memoryview(buf)[offset : offset + size]
+
+
+def sizeof(desc, layout=NATIVE):
+    size = 0
+    for value in desc.values():
+        if isinstance(value, tuple):
+            end = (value[0] & _OFFSET_MASK) + (value[1] & _OFFSET_MASK) * _SIZES[
+                (value[1] >> _TYPE_SHIFT) & 0xF
+            ]
+        else:
+            end = (value & _OFFSET_MASK) + _SIZES[(value >> _TYPE_SHIFT) & 0xF]
+        size = max(size, end)
+    return size
+
+
+class struct:
+    def __init__(self, addr, desc, layout=NATIVE):
+        buf, offset = _resolve(addr)
+        object.__setattr__(self, "_buf", buf)
+        object.__setattr__(self, "_offset", offset)
+        object.__setattr__(self, "_desc", desc)
+        object.__setattr__(self, "_order", "big" if layout == BIG_ENDIAN else "little")
+
+    def _field(self, name):
+        try:
+            return self._desc[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getattr__(self, name):
+        spec = self._field(name)
+        if isinstance(spec, tuple):
+            start = self._offset + (spec[0] & _OFFSET_MASK)
+            return memoryview(self._buf)[start : start + (spec[1] & _OFFSET_MASK)]
+        kind = (spec >> _TYPE_SHIFT) & 0xF
+        start = self._offset + (spec & _OFFSET_MASK)
+        size = _SIZES[kind]
+        raw = int.from_bytes(self._buf[start : start + size], self._order)
+        if kind >= 8:
+            pos = (spec >> BF_POS) & 0x1F
+            length = (spec >> BF_LEN) & 0x1F
+            return (raw >> pos) & ((1 << length) - 1)
+        return raw
+
+    def __setattr__(self, name, value):
+        spec = self._field(name)
+        kind = (spec >> _TYPE_SHIFT) & 0xF
+        start = self._offset + (spec & _OFFSET_MASK)
+        size = _SIZES[kind]
+        if kind >= 8:
+            pos = (spec >> BF_POS) & 0x1F
+            length = (spec >> BF_LEN) & 0x1F
+            mask = ((1 << length) - 1) << pos
+            raw = int.from_bytes(self._buf[start : start + size], self._order)
+            value = (raw & ~mask) | ((value << pos) & mask)
+        value &= (1 << (8 * size)) - 1
+        self._buf[start : start + size] = value.to_bytes(size, self._order)
@@ -0,0 +1,3 @@
+"""CPython stand-in for ``urandom``."""
+
+from random import choice, getrandbits, randint, random, seed, uniform  # noqa: F401
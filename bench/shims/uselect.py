@@ -0,0 +1,72 @@
+"""CPython stand-in for MicroPython's ``uselect`` module.
+
+Real sockets are polled through the host ``select.poll``; objects without a
+file descriptor (such as ``eventloop.Signal``) are polled through their
+``ioctl`` method, the same way MicroPython's poller does it.
+"""
+
+import select as _host
+import time
+
+POLLIN = _host.POLLIN
+POLLOUT = _host.POLLOUT
+POLLERR = _host.POLLERR
+POLLHUP = _host.POLLHUP
+
+_MP_STREAM_POLL = 3
+_IOCTL_STEP_S = 0.0005
+
+
+class poll:
+    def __init__(self):
+        self._host = _host.poll()
+        self._fds = {}
+        self._streams = {}
+
+    def register(self, obj, eventmask=POLLIN | POLLOUT):
+        if not hasattr(obj, "ioctl"):
+            fd = obj.fileno()
+            self._fds[fd] = obj
+            self._host.register(fd, eventmask)
+        else:
+            self._streams[id(obj)] = (obj, eventmask)
+
+    def unregister(self, obj):
+        if not hasattr(obj, "ioctl"):
+            for fd, known in list(self._fds.items()):
+                if known is obj:
+                    del self._fds[fd]
+                    try:
+                        self._host.unregister(fd)
+                    except (KeyError, ValueError):
+                        pass
+        else:
+            self._streams.pop(id(obj), None)
+
+    def modify(self, obj, eventmask):
+        self.unregister(obj)
+        self.register(obj, eventmask)
+
+    def _ready_streams(self):
+        ready = []
+        for obj, mask in self._streams.values():
+            flags = obj.ioctl(_MP_STREAM_POLL, mask)
+            if flags:
+                ready.append((obj, flags))
+        return ready
+
+    def poll(self, timeout=-1):
+        deadline = None if timeout < 0 else time.monotonic() + timeout / 1000
+        while True:
+            ready = self._ready_streams()
+            step = 0 if ready else (_IOCTL_STEP_S if self._streams else None)
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+                step = remaining if step is None else min(step, remaining)
+            events = self._host.poll(None if step is None else step * 1000)
+            ready.extend((self._fds[fd], ev) for fd, ev in events)
+            if ready or (deadline is not None and time.monotonic() >= deadline):
+                return ready
+
+    def ipoll(self, timeout=-1, flags=0):
+        return iter(self.poll(timeout))
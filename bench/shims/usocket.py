@@ -0,0 +1,83 @@
+"""CPython stand-in for ``usocket``.
+
+Sockets are wrapped to expose the MicroPython stream methods umqtt relies
+on: ``read``, ``readinto`` (no short reads), ``write(buf, n)``,
+``setblocking`` and ``settimeout``.
+"""
+
+import socket as _socket
+
+AF_INET = _socket.AF_INET
+SOCK_STREAM = _socket.SOCK_STREAM
+getaddrinfo = _socket.getaddrinfo
+
+
+class StreamSocket:
+    def __init__(self, sock=None):
+        self._sock = sock if sock is not None else _socket.socket()
+        self._timeout = None
+        self.writes = 0
+
+    def connect(self, addr):
+        self._sock.connect(addr)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def setblocking(self, flag):
+        self.settimeout(None if flag else 0.0)
+
+    def settimeout(self, value):
+        self._timeout = value
+        self._sock.settimeout(value)
+
+    def write(self, buf, n=None):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        view = memoryview(buf)
+        if n is not None:
+            view = view[:n]
+        self.writes += 1
+        self._sock.sendall(view)
+        return len(view)
+
+    def readinto(self, buf, n=None):
+        view = memoryview(buf)
+        n = len(view) if n is None else n
+        try:
+            got = self._sock.recv_into(view[:n], n)
+        except BlockingIOError:
+            return None
+        if got == 0 or got == n:
+            return got
+
+        # Once a read started, wait for the rest like MicroPython streams do
+        self._sock.setblocking(True)
+        try:
+            while got < n:
+                k = self._sock.recv_into(view[got:n], n - got)
+                if k == 0:
+                    break
+                got += k
+        finally:
+            self._sock.settimeout(self._timeout)
+        return got
+
+    def read(self, n):
+        buf = bytearray(n)
+        got = self.readinto(buf, n)
+        if got is None:
+            return None
+        return bytes(buf[:got])
+
+    def close(self):
+        self._sock.close()
+
+
+def socket(*args):
+    return StreamSocket(_socket.socket(*args))
+
+
+def socketpair():
+    a, b = _socket.socketpair()
+    return StreamSocket(a), StreamSocket(b)
@@ -0,0 +1,3 @@
+import _clock  # noqa: F401
+from time import *  # noqa: F401,F403
+from time import ticks_us, ticks_ms, ticks_cpu, ticks_add, ticks_diff, sleep_us, sleep_ms  # noqa: F401
@@ -1,101 +1,266 @@
-from machine import Timer, Pin, PWM
+from machine import Pin
+from micropython import const
+from array import array
+import micropython
+import uctypes
 import utime
-from time import sleep
-
-led = Pin(25, Pin.OUT)
-
-stream = []
-started = False
-timer = Timer(-1)
-
-
-def timer_callback(timer):
-    global stream
-    global started
-
-    START = 280
-    BIT_MARK = 430
-    ZERO = 430
-    ONE = 1300
-    LEADER_SPACE = 25400
-    FRAME_START_HIGH = 3500
-    FRAME_START_LOW = 1730
-    GAP = 34950
-
-    frames = []
-    frame = []
-    current_frame = -1
-
-    # Dump the captured edges
-    print("-----CAPTURE-----")
-    for i in range(len(stream)):
-        diff = 0
-        if i > 0:
-            diff = utime.ticks_diff(stream[i][1], stream[i - 1][1])
-
-        if diff > 25200 and diff < 25600:
-            frame = []
-            current_frame += 1
-            print("Capturing frame: " + str(current_frame))
-
-        if diff > 34700 and diff < 35100:
-            frames.append(frame)
-            frame = []
-            current_frame += 1
-            print("Capturing frame: " + str(current_frame))
-
-        if stream[i][0] == 0 and diff > 340 and diff < 500:
-            frame.append(0)
-        
-        if stream[i][0] == 0 and diff > 1200 and diff < 1400:
-            frame.append(1)
-
-    frames.append(frame)
-    
-    print(frames)
-
-    byte_frames = []
-    for frame in frames:
-        byte_arr = []
-        count = 0
-        byte = 0
-        for b in frame:
-            byte |= b << count
-            count += 1
-
-            if count > 7:
-                byte_arr.append("0x{:02x}".format(byte))
-
-                count = 0
-                byte = 0
-            
-        byte_frames.append(byte_arr)
-
-    print(byte_frames)
-
-    print("-----END OF CAPTURE-----")
-    started = False
-    stream = []
-
-def callback(pin):
-    global led
-    global stream
-    global started
-    global timer 
-
-    led.value(1)
-    
-    if started == False:
-        # Capture for 500ms
-        timer.init(period=750, mode=Timer.ONE_SHOT, callback=timer_callback)
-        started = True
-
-    stream.append((pin.value(), utime.ticks_us()))
-
-    led.value(0)
-    
-pin = Pin(22, Pin.IN)
-pin.irq(callback, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING)
-
-while True:
-    sleep(1)
\ No newline at end of file
+
+import daikinencoder
+
+micropython.alloc_emergency_exception_buf(100)
+
+# Edges are stored as ticks_us() with the pin level in the lowest bit
+_LEVEL_MASK = const(0x1)
+_TICKS_MASK = const(0x3FFFFFFE)
+
+# Symbol classification thresholds (in us). The receiver output is active
+# low: a low level is a mark (carrier on), a high level is a space.
+_MARK_MAX = const(1500)
+_FRAME_START_HIGH_MIN = const(2600)
+_FRAME_START_HIGH_MAX = const(4500)
+_ZERO_MAX = const(850)
+_ONE_MAX = const(1500)
+_FRAME_START_LOW_MAX = const(2600)
+_GAP_MIN = const(20000)
+_SILENCE_MIN = const(60000)
+
+# Decoder states
+_IDLE = const(0)
+_FRAME_START = const(1)
+_BITS = const(2)
+
+_FRAME_SIZES = (
+    daikinencoder.FRAME_1_SIZE,
+    daikinencoder.FRAME_2_SIZE,
+    daikinencoder.FRAME_3_SIZE,
+)
+_STATE_SIZE = const(35)
+
+
+class EdgeCapture:
+    """Captures receiver edges from a hard IRQ into a fixed ring buffer.
+
+    The IRQ handler only stores a packed timestamp, nothing is allocated in
+    interrupt context. Edges arriving while the ring is full are dropped and
+    counted in overflows.
+    """
+
+    def __init__(self, pin, size=1024):
+        self.pin = Pin(pin, Pin.IN)
+        self.overflows = 0
+
+        self._ring = array("L", [0] * size)
+        self._size = size
+        self._head = 0
+        self._tail = 0
+
+    def start(self):
+        self.pin.irq(self._irq, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING, hard=True)
+
+    def stop(self):
+        self.pin.irq(None)
+
+    def _irq(self, pin):
+        head = self._head
+        nxt = head + 1
+        if nxt == self._size:
+            nxt = 0
+
+        if nxt == self._tail:
+            self.overflows += 1
+            return
+
+        self._ring[head] = (utime.ticks_us() & _TICKS_MASK) | pin.value()
+        self._head = nxt
+
+    def pending(self):
+        return self._head != self._tail
+
+    def read(self):
+        # Oldest captured edge, or -1 when the ring is empty
+        tail = self._tail
+        if tail == self._head:
+            return -1
+
+        edge = self._ring[tail]
+        tail += 1
+        self._tail = 0 if tail == self._size else tail
+        return edge
+
+    def drain_into(self, buf, n):
+        # Appends the captured edges to buf from index n, returns the new length
+        size = len(buf)
+        while n < size:
+            edge = self.read()
+            if edge < 0:
+                break
+            buf[n] = edge
+            n += 1
+        return n
+
+
+class FrameDecoder:
+    """Streaming Daikin decoder, fed one captured edge at a time.
+
+    Each edge closes the previous symbol, which is classified right away
+    (mark, frame start, bit or gap) and assembled in place into a state
+    buffer. Every frame is checked against its checksum, and on_state is
+    called with the decoded power, mode, temperature and fan as soon as the
+    last bit of frame 3 arrived.
+    """
+
+    def __init__(self, on_state=None):
+        self.on_state = on_state
+        self.frames = 0
+        self.errors = 0
+
+        self.state_raw = bytearray(_STATE_SIZE)
+        self.state = uctypes.struct(
+            uctypes.addressof(self.state_raw),
+            daikinencoder.DaikinESPProtocol,
+            uctypes.LITTLE_ENDIAN,
+        )
+
+        # Frame contents without their checksum byte
+        view = memoryview(self.state_raw)
+        self._sum_views = []
+        offset = 0
+        for size in _FRAME_SIZES:
+            self._sum_views.append(view[offset : offset + size - 1])
+            offset += size
+
+        self._last = -1
+        self.reset()
+
+    def reset(self):
+        self._state = _IDLE
+        self._frame = 0
+        self._offset = 0
+        self._end = 0
+        self._pos = 0
+        self._bit = 0
+        self._byte = 0
+
+    def _error(self):
+        self.errors += 1
+        self.reset()
+
+    def feed(self, edge):
+        ticks = edge & _TICKS_MASK
+        if self._last < 0:
+            self._last = edge
+            return
+
+        duration = utime.ticks_diff(ticks, self._last & _TICKS_MASK)
+        mark = self._last & _LEVEL_MASK == 0
+        self._last = edge
+
+        if mark:
+            if _FRAME_START_HIGH_MIN < duration < _FRAME_START_HIGH_MAX:
+                self._start_frame()
+            elif duration > _MARK_MAX and self._state != _IDLE:
+                self._error()
+            return
+
+        # Space: bits are only meaningful inside a frame
+        if duration > _SILENCE_MIN:
+            # Longer than any gap, whatever comes next is a new transmission
+            if self._state != _IDLE:
+                self.errors += 1
+            self.reset()
+            return
+
+        if duration > _GAP_MIN:
+            # Frames of a transmission are separated by gaps, a
+            # transmission starts with a leader gap after the preamble
+            if self._state != _IDLE:
+                self._error()
+            return
+
+        if self._state == _FRAME_START:
+            if _ONE_MAX < duration < _FRAME_START_LOW_MAX:
+                self._state = _BITS
+            else:
+                self._error()
+        elif self._state == _BITS:
+            if duration < _ZERO_MAX:
+                self._push_bit(0)
+            elif duration < _ONE_MAX:
+                self._push_bit(1)
+            else:
+                self._error()
+
+    def _start_frame(self):
+        if self._state != _IDLE or self._frame >= len(_FRAME_SIZES):
+            # Frame start in the middle of a frame or after frame 3: new transmission
+            if self._state != _IDLE:
+                self.errors += 1
+            self.reset()
+
+        self._end = self._offset + _FRAME_SIZES[self._frame]
+        self._state = _FRAME_START
+
+    def _push_bit(self, bit):
+        self._byte |= bit << self._bit
+        self._bit += 1
+        if self._bit < 8:
+            return
+
+        self.state_raw[self._pos] = self._byte
+        self._pos += 1
+        self._bit = 0
+        self._byte = 0
+
+        if self._pos == self._end:
+            self._end_frame()
+
+    def _end_frame(self):
+        checksum = daikinencoder.compute_sum(self._sum_views[self._frame])
+        if checksum != self.state_raw[self._end - 1]:
+            self._error()
+            return
+
+        self._frame += 1
+        self._offset = self._end
+        self._state = _IDLE
+        self.frames += 1
+
+        if self._frame == len(_FRAME_SIZES):
+            state = self.state
+            if self.on_state is not None:
+                self.on_state(state.Power, state.Mode, state.Temperature, state.Fan)
+            self.reset()
+
+
+def main():
+    led = Pin(25, Pin.OUT)
+    capture = EdgeCapture(22)
+    overflows = 0
+
+    def print_state(power, mode, temperature, fan):
+        print(
+            "Decoded state: power={0} mode={1} temperature={2} fan={3}".format(
+                power, mode, temperature, fan
+            )
+        )
+        print(["0x{:02x}".format(b) for b in decoder.state_raw])
+
+    decoder = FrameDecoder(print_state)
+
+    capture.start()
+    while True:
+        edge = capture.read()
+        if edge < 0:
+            if capture.overflows != overflows:
+                print("Edges dropped: " + str(capture.overflows - overflows))
+                overflows = capture.overflows
+            utime.sleep_ms(1)
+            continue
+
+        led.value(1)
+        decoder.feed(edge)
+        led.value(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -93,4 +93,119 @@ def get_frames(state_raw):
     offset += FRAME_2_SIZE
     frame3 = uctypes.bytearray_at(uctypes.addressof(state_raw) + offset, FRAME_3_SIZE)
 
-    return frame1, frame2, frame3
\ No newline at end of file
+    return frame1, frame2, frame3
+
+_ALL_FRAMES = 0b111
+
+# Checksum byte of each frame
+_SUM_1 = FRAME_1_SIZE - 1
+_SUM_2 = FRAME_1_SIZE + FRAME_2_SIZE - 1
+_SUM_3 = FRAME_1_SIZE + FRAME_2_SIZE + FRAME_3_SIZE - 1
+
+class DaikinState:
+    # Long lived state buffer. Setters patch the field in place and adjust the
+    # frame checksum by the byte delta, dirty has one bit per changed frame.
+    # fields is the uctypes view of the buffer, for reading.
+    __slots__ = ("raw", "fields", "dirty")
+
+    def __init__(self, raw=None):
+        self.raw = bytearray(DEFAULT_STATE if raw is None else raw)
+        self.fields = uctypes.struct(uctypes.addressof(self.raw), DaikinESPProtocol, uctypes.LITTLE_ENDIAN)
+        update_sum(self.raw, self.fields)
+        self.dirty = _ALL_FRAMES
+
+    def load(self, raw):
+        self.raw[:] = raw
+        update_sum(self.raw, self.fields)
+        self.dirty = _ALL_FRAMES
+
+    def clear_dirty(self):
+        self.dirty = 0
+
+    def _changed(self, offset, old):
+        raw = self.raw
+        delta = raw[offset] - old
+        if delta == 0:
+            return
+
+        if offset < _SUM_1:
+            sum_offset = _SUM_1
+            self.dirty |= 0b001
+        elif offset < _SUM_2:
+            sum_offset = _SUM_2
+            self.dirty |= 0b010
+        else:
+            sum_offset = _SUM_3
+            self.dirty |= 0b100
+
+        raw[sum_offset] = (raw[sum_offset] + delta) & 0xff
+
+    # Frame 1
+    def set_comfort(self, value):
+        old = self.raw[6]
+        self.fields.Comfort = value
+        self._changed(6, old)
+
+    # Frame 2 (Time and DayOfWeek share two bytes)
+    def set_time(self, minutes):
+        old_low = self.raw[13]
+        old_high = self.raw[14]
+        self.fields.Time = minutes
+        self._changed(13, old_low)
+        self._changed(14, old_high)
+
+    def set_day_of_week(self, day):
+        old = self.raw[14]
+        self.fields.DayOfWeek = day
+        self._changed(14, old)
+
+    # Frame 3
+    def set_power(self, value):
+        old = self.raw[21]
+        self.fields.Power = value
+        self._changed(21, old)
+
+    def set_mode(self, value):
+        old = self.raw[21]
+        self.fields.Mode = value
+        self._changed(21, old)
+
+    def set_temperature(self, value):
+        old = self.raw[22]
+        self.fields.Temperature = value
+        self._changed(22, old)
+
+    def set_swing_v(self, value):
+        old = self.raw[24]
+        self.fields.SwingV = value
+        self._changed(24, old)
+
+    def set_fan(self, value):
+        old = self.raw[24]
+        self.fields.Fan = value
+        self._changed(24, old)
+
+    def set_swing_h(self, value):
+        old = self.raw[25]
+        self.fields.SwingH = value
+        self._changed(25, old)
+
+    def set_powerful(self, value):
+        old = self.raw[29]
+        self.fields.Powerful = value
+        self._changed(29, old)
+
+    def set_quiet(self, value):
+        old = self.raw[29]
+        self.fields.Quiet = value
+        self._changed(29, old)
+
+    def set_sensor(self, value):
+        old = self.raw[32]
+        self.fields.Sensor = value
+        self._changed(32, old)
+
+    def set_econo(self, value):
+        old = self.raw[32]
+        self.fields.Econo = value
+        self._changed(32, old)
@@ -1,11 +1,10 @@
-from machine import Pin, PWM
 from micropython import const
+from array import array
 import time
-import uctypes
-import gc
 import _thread
 
 import daikinencoder
+import irbackend
 
 # Validation
 MIN_TEMP = 10
@@ -41,111 +40,486 @@ _FRAME_START_HIGH = const(3490)
 _FRAME_START_LOW = const(1720)
 _GAP = const(34950)
 
-# IR carrier configuration
-_DUTY_ON = const(16384)  # 1/4
-_DUTY_OFF = const(0)
-_CARRIER_FREQ = const(38000)
+# Symbol classes, for timing instrumentation
+SYMBOL_NAMES = (
+    "bit_mark",
+    "zero",
+    "one",
+    "frame_start_high",
+    "frame_start_low",
+    "gap",
+)
+SYMBOL_DURATIONS = (_BIT_MARK, _ZERO, _ONE, _FRAME_START_HIGH, _FRAME_START_LOW, _GAP)
+
+# Durations actually emitted per symbol class. They are SYMBOL_DURATIONS
+# until set_timings() installs the ones measured by ircalib.
+TIMINGS = array("H", SYMBOL_DURATIONS)
+
+_PREAMBLE_BITS = const(6)
+
+# Preamble (bits + gap), then per frame: start high/low/mark, 2 symbols per bit, gap
+PULSE_TRAIN_SIZE = (
+    _PREAMBLE_BITS * 2
+    + 1
+    + 3 * 4
+    + (
+        daikinencoder.FRAME_1_SIZE
+        + daikinencoder.FRAME_2_SIZE
+        + daikinencoder.FRAME_3_SIZE
+    )
+    * 16
+)
 
-pwm = PWM(Pin(13))
-pwm.freq(_CARRIER_FREQ)
+IR_PIN = const(13)
 
-BLASTING = False
+# Number of encoded states kept ready to send
+STATE_CACHE_SIZE = 8
 
+# Channel states
+_IDLE = const(0)
+_READY = const(1)  # Waiting for its hardware to be free
+_SENDING = const(2)
+_DONE = const(3)  # Sent, callbacks not run yet
 
-class RemoteException(Exception):
-    pass
+channels = []
 
+# True while the transmitter thread has channels to pump
+BLASTING = False
 
-def blast_ir_state(code):
-    # Sending PREAMBLE
-    for i in range(6):
-        blast_ir_signal(_DUTY_OFF, _ZERO)
-        blast_ir_signal(_DUTY_ON, _BIT_MARK)
+_lock = _thread.allocate_lock()
+_done_signal = None
 
-    blast_ir_signal(_DUTY_OFF, _GAP)
+# Frame 2 clock, see set_clock(). Until it is set, frame 2 keeps the
+# DEFAULT_STATE time.
+_clock_minutes = -1
+_clock_day = 0
 
-    # Sending command
-    for frame in code:
-        blast_ir_signal(_DUTY_ON, _FRAME_START_HIGH)
-        blast_ir_signal(_DUTY_OFF, _FRAME_START_LOW)
-        blast_ir_signal(_DUTY_ON, _BIT_MARK)
+# The transmitter thread is started once and parks on _wake when idle, so a
+# transmission doesn't allocate a new thread and stack
+_started = False
+_wake = _thread.allocate_lock()
+_wake.acquire()
 
-        for byte in frame:
-            for i in range(8):
-                bit = byte >> i & 1
-                blast_ir_signal(_DUTY_OFF, _ONE if bit == 1 else _ZERO)
-                blast_ir_signal(_DUTY_ON, _BIT_MARK)
 
-        blast_ir_signal(_DUTY_OFF, _GAP)
+class RemoteException(Exception):
+    pass
 
 
-def blast_ir_signal(signal, length):
-    pwm.duty_u16(signal)
-    time.sleep_us(length)
+def _frame_symbols(size):
+    # Frame start high/low/mark, 2 symbols per bit, gap
+    return 3 + size * 16 + 1
+
+
+def encode_pulse_train(code, train=None, frames=0b111, timings=None):
+    # Flatten the frames into alternating space/mark durations (see irbackend).
+    # Only the frames set in the frames bitmask are rewritten, the others are
+    # expected to already be in train. Durations come from timings, one per
+    # symbol class, TIMINGS by default.
+    if train is None:
+        train = array("H", [0] * PULSE_TRAIN_SIZE)
+    if timings is None:
+        timings = TIMINGS
+
+    bit_mark = timings[0]
+    zero = timings[1]
+    one = timings[2]
+    gap = timings[5]
+
+    # Preamble
+    i = 0
+    for _ in range(_PREAMBLE_BITS):
+        train[i] = zero
+        train[i + 1] = bit_mark
+        i += 2
+
+    train[i] = gap
+    i += 1
+
+    # Command
+    for n in range(len(code)):
+        frame = code[n]
+        if not frames & 1 << n:
+            i += _frame_symbols(len(frame))
+            continue
+
+        train[i] = timings[3]
+        train[i + 1] = timings[4]
+        train[i + 2] = bit_mark
+        i += 3
 
-    return length
+        for byte in frame:
+            for b in range(8):
+                train[i] = one if byte >> b & 1 else zero
+                train[i + 1] = bit_mark
+                i += 2
 
+        train[i] = gap
+        i += 1
 
-def prepare_state(power, mode, temperature, fan):
-    state_raw = bytearray(daikinencoder.DEFAULT_STATE)
-    state = uctypes.struct(
-        uctypes.addressof(state_raw),
-        daikinencoder.DaikinESPProtocol,
-        uctypes.LITTLE_ENDIAN,
-    )
+    return train
 
-    if power == "on":
-        state.Power = 1
-    else:
-        state.Power = 0
+
+def state_key(power, mode, temperature, fan):
+    # Validates a state and packs it into a small int: power, mode, temperature, fan
+    power_value = POWER_ON if power == "on" else POWER_OFF
 
     try:
-        state.Mode = MODE_MAP[mode]
+        mode_value = MODE_MAP[mode]
     except:
         raise RemoteException(
             "Invalid mode given... Possible values: heat, cool, auto, dry, fan_only or off"
         )
 
     try:
-        temperature_value = int(float(temperature))
+        # Ints are taken as is, strings such as "21.0" go through float
+        if type(temperature) is int:
+            temperature_value = temperature
+        else:
+            temperature_value = int(float(temperature))
         if temperature_value < MIN_TEMP or temperature_value > MAX_TEMP:
             raise Exception()
-
-        state.Temperature = temperature_value
     except:
         raise RemoteException("Temperature must be between 10 and 32 (celcius)...")
 
     try:
-        state.Fan = FAN_MAP[fan]
+        fan_value = FAN_MAP[fan]
     except:
         raise RemoteException(
             "Invalid fan value... Possible values: Auto, Quiet, 1, 2, 3, 4 or 5."
         )
 
-    daikinencoder.update_sum(state_raw, state)
-    return state_raw
+    return power_value | mode_value << 1 | temperature_value << 4 | fan_value << 11
 
 
-def thread_blast_ir_state(code):
-    global BLASTING
-    try:
+def apply_key(state, key):
+    # Sets the fields of a DaikinState from a state_key()
+    state.set_power(key & 0x1)
+    state.set_mode(key >> 1 & 0x7)
+    state.set_temperature(key >> 4 & 0x7F)
+    state.set_fan(key >> 11 & 0xF)
+
+
+def prepare_state(power, mode, temperature, fan):
+    key = state_key(power, mode, temperature, fan)
+
+    state = daikinencoder.DaikinState()
+    apply_key(state, key)
+    return state.raw
+
+
+class StateCache:
+    """LRU cache of encoded states, keyed by state_key().
+
+    All buffers are allocated up front: a miss re-encodes the least recently
+    used entry in place, a hit returns its pulse train as is. Entries are
+    DaikinState objects, so a miss only rewrites the fields and frames that
+    differ from the evicted state. Once set_clock() was called, frame 2 of
+    the returned entry is brought up to date as well.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        self._clock = 0
+        self._keys = array("l", [-1] * size)
+        self._used = array("L", [0] * size)
+        self._states = []
+        self._trains = []
+        for _ in range(size):
+            self._states.append(daikinencoder.DaikinState())
+            self._trains.append(array("H", [0] * PULSE_TRAIN_SIZE))
+
+    def _lookup(self, key):
+        keys = self._keys
+        for i in range(self.size):
+            if keys[i] == key:
+                return i
+
+        return -1
+
+    def _evict(self):
+        used = self._used
+        oldest = 0
+        for i in range(1, self.size):
+            if used[i] < used[oldest]:
+                oldest = i
+
+        return oldest
+
+    def get(self, key):
+        i = self._lookup(key)
+        if i >= 0:
+            self.hits += 1
+            state = self._states[i]
+        else:
+            self.misses += 1
+            i = self._evict()
+
+            # Invalidate first, the entry is unusable until fully encoded
+            self._keys[i] = -1
+            state = self._states[i]
+            apply_key(state, key)
+
+        if _clock_minutes >= 0:
+            state.set_time(_clock_minutes)
+            state.set_day_of_week(_clock_day)
+
+        if state.dirty:
+            encode_pulse_train(
+                daikinencoder.get_frames(state.raw), self._trains[i], state.dirty
+            )
+            state.clear_dirty()
+        self._keys[i] = key
+
+        self._clock += 1
+        self._used[i] = self._clock
+        return self._trains[i]
+
+    def state_raw(self, key):
+        i = self._lookup(key)
+        return self._states[i].raw if i >= 0 else None
+
+    def clear(self):
+        # Entries are encoded again from scratch, as after set_timings()
+        for i in range(self.size):
+            self._keys[i] = -1
+            self._used[i] = 0
+            self._states[i].dirty = 0b111
+
+
+class Channel:
+    """One IR emitter, with its own state cache and send queue.
+
+    send_async() and poll() are called from the main thread. The trains
+    themselves are fed to the backends by the transmitter thread on the
+    second core, which runs channels in parallel unless their backends
+    share hardware (same pin, or an exclusive backend).
+    """
+
+    def __init__(self, backend, cache_size=STATE_CACHE_SIZE):
+        self.backend = backend
+        self.state_cache = StateCache(cache_size)
+
+        # ticks_us() at which the last transmission was handed to the transmitter
+        self.last_blast_start = 0
+
+        self._status = _IDLE
+        self._train = None
+        self._error = None
+        # Lists are swapped rather than replaced, sending doesn't allocate
+        self._callbacks = []
+        self._done_callbacks = []
+        self._queued_key = -1
+        self._queued_callbacks = []
+
+    def busy(self):
+        return self._status != _IDLE
+
+    def _start(self, key):
+        self._train = self.state_cache.get(key)
+
         print("Sending IR state to Daikin unit...")
-        blast_ir_state(code)
-    finally:
-        BLASTING = False
+        self._error = None
+        self.last_blast_start = time.ticks_us()
+        _schedule(self)
+
+    def send_async(self, power, mode, temperature, fan, callback=None):
+        # Returns right away, callback(error) is called from poll() once the
+        # state has been sent (error is None) or failed (error is a RemoteException).
+        try:
+            key = state_key(power, mode, temperature, fan)
+        except RemoteException as e:
+            if callback is not None:
+                callback(e)
+            return
+
+        if self._status != _IDLE:
+            # Only the latest queued state is worth sending once the unit is free
+            self._queued_key = key
+            if callback is not None:
+                self._queued_callbacks.append(callback)
+            return
+
+        if callback is not None:
+            self._callbacks.append(callback)
+        self._start(key)
+
+    def poll(self):
+        # Completes a finished transmission, returns True while one is in progress.
+        if self._status != _DONE:
+            return self._status != _IDLE
+
+        callbacks = self._callbacks
+        error = self._error
+        self._callbacks = self._done_callbacks
+        self._done_callbacks = callbacks
+        self._status = _IDLE
+
+        if self._queued_key >= 0:
+            queued = self._queued_callbacks
+            self._queued_callbacks = self._callbacks
+            self._callbacks = queued
+            key = self._queued_key
+            self._queued_key = -1
+            self._start(key)
+
+        for callback in callbacks:
+            callback(error)
+        callbacks.clear()
+
+        return self._status != _IDLE
+
+
+def add_channel(backend):
+    channel = Channel(backend)
+    channels.append(channel)
+    return channel
+
+
+def default_channel():
+    if not channels:
+        add_channel(irbackend.PIOBackend(IR_PIN))
+    return channels[0]
+
+
+def set_backend(new_backend):
+    if channels:
+        channels[0].backend = new_backend
+    else:
+        add_channel(new_backend)
 
 
-def send_daikin_state(power, mode, temperature, fan):
-    global BLASTING
+def set_timings(timings):
+    # Emitted durations per symbol class, in SYMBOL_NAMES order. Only call
+    # it while nothing is being sent: every cached train is encoded again.
+    for i in range(len(TIMINGS)):
+        TIMINGS[i] = timings[i]
+    for channel in channels:
+        channel.state_cache.clear()
+
+
+def set_clock(minutes, day):
+    # Minutes past midnight and day of week (Sunday = 1) sent in frame 2
+    global _clock_minutes, _clock_day
+    _clock_minutes = minutes
+    _clock_day = day
+
 
-    state_raw = prepare_state(power, mode, temperature, fan)
+def set_done_signal(signal):
+    # signal.set() is called from the transmitter thread when a transmission ends
+    global _done_signal
+    _done_signal = signal
 
-    gc.collect()
 
+def _schedule(channel):
+    global BLASTING, _started
+
+    _lock.acquire()
+    channel._status = _READY
+    wake = not BLASTING
     BLASTING = True
-    _thread.start_new_thread(
-        thread_blast_ir_state, (daikinencoder.get_frames(state_raw),)
-    )
+    _lock.release()
+
+    if not wake:
+        return
+
+    if _started:
+        _wake.release()
+    else:
+        _started = True
+        _thread.start_new_thread(_transmit, ())
+
+
+def _can_start(channel):
+    backend = channel.backend
+    for other in channels:
+        if other._status == _SENDING and (
+            backend.exclusive
+            or other.backend.exclusive
+            or other.backend.pin == backend.pin
+        ):
+            return False
+
+    return True
+
+
+def _finish(channel, error):
+    if error is not None:
+        channel._error = RemoteException("IR transmission failed: " + str(error))
+    channel._status = _DONE
+    if _done_signal is not None:
+        _done_signal.set()
+
+
+def _transmit():
+    # Transmitter thread: pumps every sending channel until none is left,
+    # then waits for _schedule() to wake it up
+    global BLASTING
+
+    while True:
+        active = False
+        for channel in channels:
+            if channel._status == _READY and _can_start(channel):
+                try:
+                    channel.backend.start(channel._train)
+                    channel._status = _SENDING
+                except Exception as e:
+                    _finish(channel, e)
+
+            if channel._status == _SENDING:
+                try:
+                    if not channel.backend.pump():
+                        _finish(channel, None)
+                except Exception as e:
+                    _finish(channel, e)
+
+            if channel._status == _READY or channel._status == _SENDING:
+                active = True
+
+        if active:
+            continue
+
+        # A channel may have been scheduled since it was checked
+        _lock.acquire()
+        for channel in channels:
+            if channel._status == _READY:
+                active = True
+        if not active:
+            BLASTING = False
+        _lock.release()
+
+        if not active:
+            _wake.acquire()
+
+
+def blast_ir_state(code):
+    default_channel().backend.send(encode_pulse_train(code))
+
+
+def send_daikin_state_async(power, mode, temperature, fan, callback=None):
+    default_channel().send_async(power, mode, temperature, fan, callback)
+
+
+def poll_send():
+    # Completes finished transmissions on every channel, returns True while
+    # one of them is busy.
+    busy = False
+    for channel in channels:
+        if channel.poll():
+            busy = True
+
+    return busy
+
+
+def send_daikin_state(power, mode, temperature, fan):
+    result = []
+    send_daikin_state_async(power, mode, temperature, fan, result.append)
+
+    while not result:
+        poll_send()
+        time.sleep_ms(1)
 
-    while BLASTING:
-        time.sleep_ms(100)
+    if result[0] is not None:
+        raise result[0]
@@ -0,0 +1,78 @@
+# h * 31 + byte stays below 2**30, a small int on MicroPython
+_HASH_MASK = 0x1FFFFFF
+
+
+def buffer_hash(b):
+    h = len(b)
+    for byte in b:
+        h = (h * 31 + byte) & _HASH_MASK
+    return h
+
+
+def buffer_equal(a, b):
+    n = len(a)
+    if n != len(b):
+        return False
+    for i in range(n):
+        if a[i] != b[i]:
+            return False
+    return True
+
+
+def put_bytes(buf, pos, b):
+    # Copies b into buf at pos, returns the position after it
+    end = pos + len(b)
+    buf[pos:end] = b
+    return end
+
+
+def match_value(msg, encoded_values, values):
+    # Returns the value whose encoded form equals msg, or None
+    for i in range(len(encoded_values)):
+        if buffer_equal(encoded_values[i], msg):
+            return values[i]
+    return None
+
+
+def parse_int(msg):
+    # Integer part of a decimal payload such as b"21.0", -1 if invalid
+    value = 0
+    digits = 0
+    for byte in msg:
+        if byte == 0x2E:  # "."
+            break
+        if byte < 0x30 or byte > 0x39:
+            return -1
+        value = value * 10 + byte - 0x30
+        digits += 1
+    return value if digits else -1
+
+
+class TopicTable:
+    """Maps topics to handlers, built once from the subscribed topics.
+
+    Lookups take any buffer (memoryviews from the MQTT client) and only hash
+    and compare bytes in place, so they don't allocate.
+    """
+
+    def __init__(self):
+        self._table = {}
+
+    def add(self, topic, handler):
+        key = buffer_hash(topic)
+        entry = (topic, handler)
+        if key in self._table:
+            self._table[key].append(entry)
+        else:
+            self._table[key] = [entry]
+
+    def lookup(self, topic):
+        entries = self._table.get(buffer_hash(topic))
+        if entries is None:
+            return None
+
+        for entry in entries:
+            if buffer_equal(entry[0], topic):
+                return entry[1]
+
+        return None
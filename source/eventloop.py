@@ -0,0 +1,124 @@
+import io
+import uselect
+import time
+
+# ioctl request used by MicroPython's stream poller
+_MP_STREAM_POLL = 3
+
+
+class Signal(io.IOBase):
+    """Flag that can be registered in a poller and set from another thread.
+
+    It reports itself readable while set, so a blocking poll() returns as
+    soon as the flag is raised.
+    """
+
+    def __init__(self):
+        self._state = 0
+
+    def ioctl(self, req, flags):
+        if req == _MP_STREAM_POLL:
+            return self._state * flags
+        return None
+
+    def set(self):
+        self._state = 1
+
+    def clear(self):
+        self._state = 0
+
+
+class EventLoop:
+    """Single threaded loop waking on readable streams and timers.
+
+    Handlers are plain callables. Timers are [deadline, period, callback]
+    lists, deadlines in ticks_ms; a period of 0 means one-shot.
+    """
+
+    def __init__(self):
+        self._poll = uselect.poll()
+        self._readers = {}
+        self._timers = []
+        self.running = False
+
+    def add_reader(self, stream, handler):
+        self._poll.register(stream, uselect.POLLIN)
+        self._readers[stream] = handler
+
+    def remove_reader(self, stream):
+        if stream in self._readers:
+            del self._readers[stream]
+            self._poll.unregister(stream)
+
+    def call_later(self, delay_ms, callback, period=0):
+        timer = [time.ticks_add(time.ticks_ms(), delay_ms), period, callback]
+        self._timers.append(timer)
+        return timer
+
+    def call_every(self, period_ms, callback):
+        return self.call_later(period_ms, callback, period_ms)
+
+    def timer(self, callback):
+        # One-shot timer created once and armed with start(), so code on a
+        # hot path can schedule itself without allocating
+        return [0, 0, callback]
+
+    def start(self, timer, delay_ms):
+        # (Re)arms timer, it runs once after delay_ms
+        timer[0] = time.ticks_add(time.ticks_ms(), delay_ms)
+        for armed in self._timers:
+            if armed is timer:
+                return
+        self._timers.append(timer)
+
+    def cancel(self, timer):
+        if timer in self._timers:
+            self._timers.remove(timer)
+
+    def _next_timeout(self, now):
+        timeout = -1
+        for timer in self._timers:
+            remaining = time.ticks_diff(timer[0], now)
+            if remaining < 0:
+                remaining = 0
+            if timeout < 0 or remaining < timeout:
+                timeout = remaining
+
+        return timeout
+
+    def _run_timers(self, now):
+        i = 0
+        while i < len(self._timers):
+            timer = self._timers[i]
+            if time.ticks_diff(now, timer[0]) < 0:
+                i += 1
+                continue
+
+            if timer[1]:
+                timer[0] = time.ticks_add(timer[0], timer[1])
+                if time.ticks_diff(now, timer[0]) >= 0:
+                    # Don't try to catch up after a long stall
+                    timer[0] = time.ticks_add(now, timer[1])
+                i += 1
+            else:
+                self._timers.pop(i)
+
+            timer[2]()
+
+    def run_once(self):
+        timeout = self._next_timeout(time.ticks_ms())
+
+        for event in self._poll.ipoll(timeout):
+            handler = self._readers.get(event[0])
+            if handler is not None:
+                handler()
+
+        self._run_timers(time.ticks_ms())
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
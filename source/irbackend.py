@@ -0,0 +1,216 @@
+from machine import Pin, PWM
+from micropython import const
+from array import array
+import time
+import rp2
+
+# Pulse trains are flat arrays of durations (in us). Even indexes are spaces
+# (carrier off), odd indexes are marks (carrier on), starting with a space.
+#
+# Backends transmit either in one blocking send(train), or with start(train)
+# followed by pump() calls until it returns False. exclusive backends keep the
+# CPU busy while transmitting and can't overlap with any other transmission.
+
+# IR carrier configuration
+_DUTY_ON = const(16384)  # 1/4
+_DUTY_OFF = const(0)
+_CARRIER_FREQ = const(38000)
+
+# The PIO program runs at 1 MHz so one instruction cycle is 1 us. A carrier
+# period is 26 cycles (~38.4 kHz), 7 of them high (~1/4 duty).
+_PIO_FREQ = const(1_000_000)
+_CARRIER_PERIOD = const(26)
+_SPACE_OVERHEAD = const(5)
+_FIFO_DEPTH = const(8)
+
+
+@rp2.asm_pio(set_init=rp2.PIO.OUT_LOW, fifo_join=rp2.PIO.JOIN_TX)
+def _ir_modulator():
+    # Space: carrier off for x + 1 cycles
+    label("start")
+    pull()
+    mov(x, osr)
+    label("space")
+    jmp(x_dec, "space")
+
+    # Mark: y + 1 carrier periods, none when y is 0 (pads odd length trains).
+    # Jump targets have to be instructions of the program.
+    pull()
+    mov(y, osr)
+    jmp(not_y, "start")
+    label("mark")
+    set(pins, 1)[6]
+    set(pins, 0)[17]
+    jmp(y_dec, "mark")
+
+
+class PIOBackend:
+    """Replays pulse trains through a PIO state machine generating the carrier.
+
+    Timing is done by the PIO block, so the interpreter only has to keep the
+    TX FIFO fed. pump() never blocks: several state machines can be fed in
+    turn from a single thread.
+    """
+
+    exclusive = False
+
+    def __init__(self, pin, sm_id=0):
+        self.pin = pin
+        self._sm = rp2.StateMachine(
+            sm_id, _ir_modulator, freq=_PIO_FREQ, set_base=Pin(pin, Pin.OUT)
+        )
+        self._words = array("H")
+        self._next = 0
+        self._end = -1
+        self._tail = 0
+        self._sm.active(1)
+
+    def _to_words(self, train):
+        # Trains end with a space, an empty mark keeps the program in step
+        n = len(train)
+        size = n + (n & 1)
+        if len(self._words) != size:
+            self._words = array("H", [0] * size)
+
+        words = self._words
+        for i in range(0, n, 2):
+            d = train[i]
+            words[i] = d - _SPACE_OVERHEAD if d > _SPACE_OVERHEAD else 0
+        for i in range(1, n, 2):
+            d = (train[i] + _CARRIER_PERIOD // 2) // _CARRIER_PERIOD
+            words[i] = d - 1 if d > 1 else 1
+        if size > n:
+            words[n] = 0
+
+        return words
+
+    def start(self, train):
+        self._to_words(train)
+        self._next = 0
+        self._end = -1
+        self._tail = train[len(train) - 1]
+
+    def pump(self):
+        # Tops up the TX FIFO, returns True until the whole train is out
+        sm = self._sm
+        if self._end < 0:
+            words = self._words
+            n = len(words)
+            i = self._next
+            while i < n and sm.tx_fifo() < _FIFO_DEPTH:
+                sm.put(words[i])
+                i += 1
+            self._next = i
+
+            if i < n or sm.tx_fifo():
+                return True
+
+            # Only the final space is left in the state machine
+            self._end = time.ticks_add(time.ticks_us(), self._tail)
+
+        return time.ticks_diff(self._end, time.ticks_us()) > 0
+
+    def send(self, train):
+        self.start(train)
+        while self.pump():
+            pass
+
+
+class PWMBackend:
+    """Replays pulse trains by toggling the PWM duty cycle from the CPU.
+
+    Each edge is scheduled against an absolute deadline, so interpreter
+    overhead shows up as jitter on single edges but never accumulates.
+    With a TimingProbe attached, every edge is timestamped and the errors
+    are recorded after the transmission; without one the loop is unchanged.
+    """
+
+    exclusive = True
+
+    def __init__(self, pin, probe=None):
+        self.pin = pin
+        self.probe = probe
+        self._train = None
+        self._pwm = PWM(Pin(pin))
+        self._pwm.freq(_CARRIER_FREQ)
+        self._pwm.duty_u16(_DUTY_OFF)
+
+    def start(self, train):
+        self._train = train
+
+    def pump(self):
+        # Busy-waits through the whole train
+        self.send(self._train)
+        return False
+
+    def send(self, train):
+        if self.probe is not None:
+            self._send_probed(train, self.probe)
+            return
+
+        duty_u16 = self._pwm.duty_u16
+        ticks_us = time.ticks_us
+        ticks_add = time.ticks_add
+        ticks_diff = time.ticks_diff
+
+        level = _DUTY_OFF
+        deadline = ticks_us()
+        for d in train:
+            duty_u16(level)
+            deadline = ticks_add(deadline, d)
+            level ^= _DUTY_ON
+            while ticks_diff(deadline, ticks_us()) > 0:
+                pass
+
+        duty_u16(_DUTY_OFF)
+
+    def _send_probed(self, train, probe):
+        duty_u16 = self._pwm.duty_u16
+        ticks_us = time.ticks_us
+        ticks_add = time.ticks_add
+        ticks_diff = time.ticks_diff
+        edges = probe.edges(len(train))
+
+        level = _DUTY_OFF
+        deadline = ticks_us()
+        i = 0
+        for d in train:
+            duty_u16(level)
+            edges[i] = ticks_us()
+            i += 1
+            deadline = ticks_add(deadline, d)
+            level ^= _DUTY_ON
+            while ticks_diff(deadline, ticks_us()) > 0:
+                pass
+
+        duty_u16(_DUTY_OFF)
+        edges[i] = ticks_us()
+
+        probe.record(train, edges)
+
+
+class RecordingBackend:
+    """Records pulse trains instead of emitting them, for host-side checks."""
+
+    exclusive = False
+
+    def __init__(self, pin=None):
+        self.pin = pin
+        self.trains = []
+
+    def start(self, train):
+        self.send(train)
+
+    def pump(self):
+        return False
+
+    def send(self, train):
+        self.trains.append(array("H", train))
+
+    def last(self):
+        return self.trains[-1] if self.trains else None
+
+    def symbols(self, index=-1):
+        # (carrier on, duration) tuples of a recorded train
+        train = self.trains[index]
+        return [(i & 1, train[i]) for i in range(len(train))]
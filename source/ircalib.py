@@ -0,0 +1,141 @@
+from micropython import const
+from array import array
+import time
+
+import daikindecoder
+import daikinencoder
+import daikinremote
+
+_TICKS_MASK = const(0x3FFFFFFE)
+
+# Encoding with these as timings gives the symbol class of every train index
+_CLASS_IDS = tuple(range(len(daikinremote.SYMBOL_DURATIONS)))
+
+
+class Calibration:
+    """Closed-loop correction of the emitted IR symbol durations.
+
+    A train is sent while a loopback receiver facing the emitter captures it
+    (an EdgeCapture). Received symbols are matched one to one with the sent
+    ones and averaged per symbol class, then every emitted duration is moved
+    by the error of its class and the train sent again, until all classes
+    are within tolerance_us of SYMBOL_DURATIONS. A capture that doesn't
+    decode to the sent state is a mismatch: it is dropped and the train sent
+    again, within the same attempts budget.
+    """
+
+    def __init__(self, backend, capture, tolerance_us=20, attempts=6):
+        self.backend = backend
+        self.capture = capture
+        self.tolerance_us = tolerance_us
+        self.attempts = attempts
+
+        classes = len(_CLASS_IDS)
+        # Emitted durations, and mean received minus nominal duration of
+        # the last matched capture, per class
+        self.timings = array("H", daikinremote.TIMINGS)
+        self.errors = array("l", [0] * classes)
+        self.rounds = 0
+        self.mismatches = 0
+
+        self._total = array("l", [0] * classes)
+        self._count = array("L", [0] * classes)
+        self._classes = array("H", [0] * daikinremote.PULSE_TRAIN_SIZE)
+        self._train = array("H", [0] * daikinremote.PULSE_TRAIN_SIZE)
+        self._edges = array("L", [0] * daikinremote.PULSE_TRAIN_SIZE)
+        self._decoder = daikindecoder.FrameDecoder(self._decoded)
+        self._expected = None
+        self._matched = False
+
+    def run(self, raw):
+        # Calibrates with the state in raw, starting from the current TIMINGS.
+        # Returns True once every class is within tolerance.
+        code = daikinencoder.get_frames(raw)
+        daikinremote.encode_pulse_train(code, self._classes, timings=_CLASS_IDS)
+        self._expected = raw
+        for i in range(len(self.timings)):
+            self.timings[i] = daikinremote.TIMINGS[i]
+            self.errors[i] = 0
+        self.rounds = 0
+        self.mismatches = 0
+
+        self.capture.start()
+        try:
+            for _ in range(self.attempts):
+                if not self._send(code):
+                    self.mismatches += 1
+                    continue
+
+                self.rounds += 1
+                if self._measure() <= self.tolerance_us:
+                    return True
+                self._correct()
+        finally:
+            self.capture.stop()
+        return False
+
+    def _send(self, code):
+        # Sends the train once, returns False if the capture doesn't match it
+        train = daikinremote.encode_pulse_train(code, self._train, timings=self.timings)
+        capture = self.capture
+        while capture.read() >= 0:
+            pass
+
+        # The final gap is part of the send, every edge is in by now
+        self.backend.send(train)
+        n = capture.drain_into(self._edges, 0)
+
+        # Receiver output is active low: the first edge starts the first mark
+        # and the trailing gap has no closing edge
+        if n != len(train) - 1 or self._edges[0] & 1:
+            return False
+
+        self._matched = False
+        decoder = self._decoder
+        for i in range(n):
+            decoder.feed(self._edges[i])
+        return self._matched
+
+    def _decoded(self, power, mode, temperature, fan):
+        self._matched = self._decoder.state_raw == self._expected
+
+    def _measure(self):
+        # Returns the largest error of a class
+        total = self._total
+        count = self._count
+        for c in range(len(total)):
+            total[c] = 0
+            count[c] = 0
+
+        edges = self._edges
+        classes = self._classes
+        for i in range(len(self._train) - 2):
+            c = classes[i + 1]
+            total[c] += time.ticks_diff(
+                edges[i + 1] & _TICKS_MASK, edges[i] & _TICKS_MASK
+            )
+            count[c] += 1
+
+        worst = 0
+        nominal = daikinremote.SYMBOL_DURATIONS
+        for c in range(len(total)):
+            if not count[c]:
+                continue
+            error = (total[c] + count[c] // 2) // count[c] - nominal[c]
+            self.errors[c] = error
+            if abs(error) > worst:
+                worst = abs(error)
+        return worst
+
+    def _correct(self):
+        # A correction beyond half or one and a half times the nominal
+        # duration means the receiver is not seeing this emitter, it is
+        # capped there
+        nominal = daikinremote.SYMBOL_DURATIONS
+        for c in range(len(self.timings)):
+            timing = self.timings[c] - self.errors[c]
+            if timing < nominal[c] // 2:
+                timing = nominal[c] // 2
+            elif timing > nominal[c] * 3 // 2:
+                timing = nominal[c] * 3 // 2
+            self.timings[c] = timing
@@ -0,0 +1,106 @@
+from micropython import const
+from array import array
+import time
+
+# Error histogram: _BINS bins of _BIN_US, the first bin starts at -_BIN_OFFSET us.
+# Errors outside the range are clamped into the first or last bin.
+_BINS = const(32)
+_BIN_US = const(8)
+_BIN_OFFSET = const(32)
+
+
+class TimingProbe:
+    """Measures how far replayed IR symbols drift from their commanded duration.
+
+    Symbols are classified by their commanded duration (one class per
+    timing constant). A backend fills edges() with one ticks_us() stamp per
+    symbol edge during a transmission, record() then folds the errors into
+    fixed-size per-class histograms.
+    """
+
+    def __init__(self, names, targets):
+        self.names = names
+        self.targets = targets
+
+        classes = len(targets)
+        self.hist = array("L", [0] * (classes * _BINS))
+        self.count = array("L", [0] * classes)
+        self.total = array("l", [0] * classes)
+        self.max = array("l", [0] * classes)
+        self._edges = array("L")
+
+    def reset(self):
+        for i in range(len(self.hist)):
+            self.hist[i] = 0
+        for i in range(len(self.targets)):
+            self.count[i] = 0
+            self.total[i] = 0
+            self.max[i] = 0
+
+    def edges(self, n):
+        # Timestamp buffer for a train of n symbols (n + 1 edges)
+        if len(self._edges) < n + 1:
+            self._edges = array("L", [0] * (n + 1))
+        return self._edges
+
+    def _class(self, duration):
+        targets = self.targets
+        for i in range(len(targets)):
+            if targets[i] == duration:
+                return i
+        return -1
+
+    def record(self, train, edges):
+        for i in range(len(train)):
+            target = train[i]
+            c = self._class(target)
+            if c < 0:
+                continue
+
+            error = time.ticks_diff(edges[i + 1], edges[i]) - target
+            self.count[c] += 1
+            self.total[c] += error
+            if error > self.max[c]:
+                self.max[c] = error
+
+            b = (error + _BIN_OFFSET) // _BIN_US
+            if b < 0:
+                b = 0
+            elif b >= _BINS:
+                b = _BINS - 1
+            self.hist[c * _BINS + b] += 1
+
+    def _percentile(self, c, count, p):
+        # Upper bound (us) of the bin holding the p-th fraction of samples
+        needed = count * p // 100
+        seen = 0
+        for b in range(_BINS):
+            seen += self.hist[c * _BINS + b]
+            if seen > needed:
+                return (b + 1) * _BIN_US - _BIN_OFFSET
+        return _BINS * _BIN_US - _BIN_OFFSET
+
+    def summary(self):
+        # Errors in us: mean, p99 (bin resolution) and max overrun, per class and overall
+        classes = {}
+        p99 = 0
+        max_overrun = 0
+        for c in range(len(self.targets)):
+            count = self.count[c]
+            if not count:
+                continue
+
+            # Never report more than the largest error actually seen
+            class_p99 = min(self._percentile(c, count, 99), self.max[c])
+            classes[self.names[c]] = {
+                "count": count,
+                "mean": self.total[c] // count,
+                "p99": class_p99,
+                "max": self.max[c],
+            }
+            if class_p99 > p99:
+                p99 = class_p99
+            if self.max[c] > max_overrun:
+                max_overrun = self.max[c]
+
+        return {"p99": p99, "max": max_overrun, "classes": classes}
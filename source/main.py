@@ -1,17 +1,101 @@
 import json
 import network
 import machine
+import ntptime
 import ubinascii
 import time
 
-from machine import Pin
+from machine import Pin, Timer
 from umqtt.robust import MQTTClient
-from daikinremote import RemoteException, send_daikin_state
+from daikinremote import poll_send
+from eventloop import EventLoop, Signal
+from statestore import StateJournal
+from dispatch import (
+    TopicTable,
+    buffer_equal,
+    match_value,
+    parse_int,
+    put_bytes,
+)
+from daikindecoder import EdgeCapture
+from irbackend import PIOBackend, PWMBackend
+from ircalib import Calibration
+from irstats import TimingProbe
+from memstats import MemoryProbe
+from scheduler import (
+    MAX_DELAY,
+    MINUTES_PER_DAY,
+    Scheduler,
+    epoch_minute,
+    minute_of_week,
+)
+
+import daikinremote
 
 from config import SSID, PASSWORD, MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASSWORD, NAME
 
+try:
+    # Commands received within this window (ms) are merged into one transmission
+    from config import COALESCE_MS
+except ImportError:
+    COALESCE_MS = 100
+
+try:
+    # Replays IR from the CPU and reports symbol timing errors on a diagnostics topic
+    from config import IR_TIMING_PROBE
+except ImportError:
+    IR_TIMING_PROBE = False
+
+try:
+    # Seconds without traffic after which the broker considers the board gone
+    from config import MQTT_KEEPALIVE
+except ImportError:
+    MQTT_KEEPALIVE = 60
+
+try:
+    # Pin of a receiver facing the emitter, for IR timing calibration. None
+    # keeps the nominal timings.
+    from config import IR_RECEIVER_PIN
+except ImportError:
+    IR_RECEIVER_PIN = None
+
+try:
+    # One entry per indoor unit: {"name": ..., "pin": ..., "sm": ...}. The PIO
+    # state machine "sm" defaults to the unit index.
+    from config import UNITS
+except ImportError:
+    UNITS = [{"name": NAME, "pin": daikinremote.IR_PIN}]
+
+try:
+    # Hardware watchdog period (ms, at most 8388 on the RP2040), None disables it.
+    # Only a wedged main loop should ever trigger it.
+    from config import WATCHDOG_MS
+except ImportError:
+    WATCHDOG_MS = 8000
+
+try:
+    # Fixed (ip, netmask, gateway, dns) instead of waiting for a DHCP lease
+    from config import STATIC_IP
+except ImportError:
+    STATIC_IP = None
+
+try:
+    # Publishes the state of a unit as a single retained JSON message instead
+    # of one topic per field
+    from config import JSON_STATE
+except ImportError:
+    JSON_STATE = False
+
+try:
+    # Local time minus UTC in minutes, schedules run on local time
+    from config import UTC_OFFSET_MINUTES
+except ImportError:
+    UTC_OFFSET_MINUTES = 0
+
 led = Pin("LED")
 led.value(0)
+led_timer = Timer()
+_led_toggles = 0
 
 wlan = network.WLAN(network.STA_IF)
 
@@ -21,112 +105,236 @@ DEFAULT_STATE = {
     "fan_mode": "Auto",
     "temperature": "21.0",
 }
-CURRENT_STATE = {}
+
+COMMANDS_MERGED = 0
+
+# Work skipped because nothing changed: commands repeating the current value,
+# transmissions of the state the unit already has, republished values
+COMMANDS_UNCHANGED = 0
+BLASTS_SUPPRESSED = 0
+PUBLISHES_SUPPRESSED = 0
+
+# Command received to IR transmission started (us)
+LATENCY_COUNT = 0
+LATENCY_TOTAL = 0
+LATENCY_MAX = 0
+
+NETWORK_CHECK_PERIOD_MS = 1000
+NETWORK_TIMEOUT_MS = 10000
+
+# Access point of the last connection: {"ssid", "bssid", "channel"}
+NETWORK_CACHE_PATH = "wifi.json"
+
+# Home Assistant discovery messages as (topic, payload), serialized once at
+# boot. They are retained, so they are only published when their hash
+# differs from the one of the last published set.
+DISCOVERY = []
+DISCOVERY_BYTES = 0
+DISCOVERY_BUILD_US = 0
+DISCOVERY_HASH = 0
+DISCOVERY_HASH_PATH = "discovery.json"
+DISCOVERY_PUBLISHES = 0
+_published_discovery_hash = None
+
+# Boot phases as (name, ms), ticks_ms() counts from reset
+BOOT_PHASES = []
+BOOT_READY_MS = 0
+_phase_start = 0
+
+# Connection supervisor: while offline, IR keeps working from the last
+# state and WLAN/MQTT are retried with backoff from the event loop
+ONLINE = False
+OFFLINE_COUNT = 0
+# How long the last offline period lasted (ms)
+OFFLINE_MS = 0
+_offline_since = 0
+_reconnect_attempt = 0
+
+# Heap figures are published this often, after a timed collection
+DIAGNOSTICS_PERIOD_MS = 60000
+
+# Keepalive and unacknowledged QoS 1 publishes are checked this often
+MQTT_CHECK_PERIOD_MS = 1000
+
+# Connect to subscriptions acknowledged, last session setup (ms)
+MQTT_READY_MS = 0
+
+# State changes are written to flash this long after the first of them, a
+# burst of changes ends up in a single record
+STATE_WRITE_DELAY_MS = 5000
+
+# Flash writes wait this long again while an IR send is in progress
+FLASH_WRITE_RETRY_MS = 200
+
+# Calibrated IR timings, see calibrate_ir(). The file also records whether
+# the last calibration succeeded, a failed one isn't repeated on every boot.
+IR_TIMING_PATH = "ir_timing.json"
+CALIBRATION_RETRY_MS = 1000
+ir_calibration = None
+ir_calibration_ok = False
+
+# Weekly programs and one-shots set over MQTT, see set_schedule()
+SCHEDULE_PATH = "schedule.json"
+SCHEDULE_TICK_MS = 1000
+SCHEDULE = {"weekly": [], "once": []}
+SCHEDULE_ENTRIES = []
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+# The RTC is set from NTP once online, then daily. Schedules wait for it.
+CLOCK_CHECK_PERIOD_MS = 60000
+CLOCK_SYNC_PERIOD_MS = 24 * 3600 * 1000
+CLOCK_SYNCED = False
+_clock_synced_at = 0
 
 FAN_MODES = ["Auto", "Quiet", "1", "2", "3", "4", "5"]
 MODES = ["auto", "off", "cool", "heat", "dry", "fan_only"]
 MIN_TEMP = 10
 MAX_TEMP = 32
 
+# Payloads are matched against these, so a command never allocates a new value
+FAN_MODE_VALUES = [fan_mode.encode("utf-8") for fan_mode in FAN_MODES]
+MODE_VALUES = [mode.encode("utf-8") for mode in MODES]
+TEMPERATURES = ["{0}.0".format(t) for t in range(MIN_TEMP, MAX_TEMP + 1)]
+
+# State values are published from here, so a confirmation never encodes
+ENCODED_VALUES = {
+    value: value.encode("utf-8") for value in ["on"] + FAN_MODES + MODES + TEMPERATURES
+}
+
+# JSON state, written piece by piece into the buffer of each unit
+_JSON_POWER = b'{"power":"'
+_JSON_MODE = b'","mode":"'
+_JSON_FAN_MODE = b'","fan_mode":"'
+_JSON_TEMPERATURE = b'","temperature":'
+_JSON_END = b"}"
+STATE_JSON_SIZE = (
+    len(_JSON_POWER + _JSON_MODE + _JSON_FAN_MODE + _JSON_TEMPERATURE + _JSON_END)
+    + len("off")
+    + max(len(mode) for mode in MODES)
+    + max(len(fan_mode) for fan_mode in FAN_MODES)
+    + max(len(temperature) for temperature in TEMPERATURES)
+)
+
 VENDOR = "glavoie84"
 ID_PREFIX = "pico-daikin-remote"
 BOARD_ID = ubinascii.hexlify(machine.unique_id()).decode("utf-8")
 UNIQUE_ID = "{0}_{1}".format(ID_PREFIX, BOARD_ID)
 
 
-def get_full_topic(topic):
-    return "{0}/{1}/{2}".format(VENDOR, UNIQUE_ID, topic).encode("utf-8")
+def get_full_topic(topic, unique_id=UNIQUE_ID):
+    return "{0}/{1}/{2}".format(VENDOR, unique_id, topic).encode("utf-8")
 
 
-MQTT_FAN_MODE_COMMAND_TOPIC = get_full_topic("fan_mode/set")
-MQTT_FAN_MODE_STATE_TOPIC = get_full_topic("fan_mode")
-MQTT_MODE_COMMAND_TOPIC = get_full_topic("mode/set")
-MQTT_MODE_STATE_TOPIC = get_full_topic("mode")
-MQTT_TEMPERATURE_COMMAND_TOPIC = get_full_topic("temperature/set")
-MQTT_TEMPERATURE_STATE_TOPIC = get_full_topic("temperature")
+_FAN_MODE_FIELD = 0x1
+_MODE_FIELD = 0x2
+_TEMPERATURE_FIELD = 0x4
 
-MQTT_DISCOVERY_TOPIC = "homeassistant/climate/{0}/config".format(UNIQUE_ID).encode(
-    "utf-8"
-)
+# wlan.status() once associated, while waiting for the DHCP lease
+_LINK_NOIP = 2
 
-c = MQTTClient(UNIQUE_ID, MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASSWORD)
+MQTT_IR_TIMING_TOPIC = get_full_topic("diagnostics/ir_timing")
+MQTT_CALIBRATION_TOPIC = get_full_topic("diagnostics/ir_calibration")
+MQTT_CALIBRATE_COMMAND_TOPIC = get_full_topic("calibrate/set")
+MQTT_BOOT_TOPIC = get_full_topic("diagnostics/boot")
+MQTT_MEMORY_TOPIC = get_full_topic("diagnostics/memory")
+MQTT_SCHEDULE_TOPIC = get_full_topic("schedule")
+MQTT_SCHEDULE_COMMAND_TOPIC = get_full_topic("schedule/set")
 
+# Home Assistant announces its (re)starts here
+HASS_STATUS_TOPIC = b"homeassistant/status"
 
-def get_hass_device():
-    return {
-        "unique_id": UNIQUE_ID,
-        "name": "Daikin IR Remote",
-        "fan_mode_command_topic": MQTT_FAN_MODE_COMMAND_TOPIC,
-        "fan_mode_state_topic": MQTT_FAN_MODE_STATE_TOPIC,
-        "fan_modes": FAN_MODES,
-        "mode_command_topic": MQTT_MODE_COMMAND_TOPIC,
-        "mode_state_topic": MQTT_MODE_STATE_TOPIC,
-        "modes": MODES,
-        "max_temp": MAX_TEMP,
-        "min_temp": MIN_TEMP,
-        "precision": 1,
-        "temperature_command_topic": MQTT_TEMPERATURE_COMMAND_TOPIC,
-        "temperature_state_topic": MQTT_TEMPERATURE_STATE_TOPIC,
-        "temperature_unit": "C",
-        "device": {
-            "identifiers": [UNIQUE_ID],
-            "name": NAME,
-            "model": "pico-daikin-remote",
-            "manufacturer": "glavoie84",
-        },
-    }
+# Retained "online" while connected, the broker publishes the "offline" will
+MQTT_AVAILABILITY_TOPIC = get_full_topic("availability")
 
+MQTT_IR_TIMING_DISCOVERY_TOPIC = "homeassistant/sensor/{0}_ir_timing/config".format(
+    UNIQUE_ID
+).encode("utf-8")
+MQTT_MEMORY_DISCOVERY_TOPIC = "homeassistant/sensor/{0}_memory/config".format(
+    UNIQUE_ID
+).encode("utf-8")
 
-def connect_to_network():
-    print("Connecting to Network (timeout 10 seconds)...")
-    wlan.active(True)
-    wlan.connect(SSID, PASSWORD)
+# machine.WDT once started, see start_watchdog()
+watchdog = None
 
-    # Wait for connect or fail
-    max_wait = 10
-    while max_wait > 0:
-        if wlan.status() < 0 or wlan.status() >= 3:
-            break
-        max_wait -= 1
-        time.sleep(1)
 
-    # Handle connection error
-    if wlan.status() != 3:
-        process_failed_network(wlan.status())
-    else:
-        blink_led(2)
+def feed_watchdog():
+    if watchdog is not None:
+        watchdog.feed()
+
 
-        status = wlan.ifconfig()
-        print("Network online! IP: " + status[0])
+c = MQTTClient(
+    UNIQUE_ID, MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASSWORD, MQTT_KEEPALIVE
+)
+c.set_last_will(MQTT_AVAILABILITY_TOPIC, "offline", True)
+# One immediate retry on a dropped connection, the supervisor takes over after
+c.MAX_ATTEMPTS = 1
+# Every blocking step of a session setup gives up after c.ping_timeout_ms,
+# kept below WATCHDOG_MS, and the watchdog is fed before each of them
+c.on_wait = feed_watchdog
+if WATCHDOG_MS is not None:
+    c.ping_timeout_ms = min(c.ping_timeout_ms, WATCHDOG_MS * 3 // 4)
+MQTT_SOCK = None
+NETWORK_CACHE = None
+COMMAND_HANDLERS = TopicTable()
 
+loop = EventLoop()
+ir_done = Signal()
 
-def process_failed_network(wlan_status):
-    blink_led(3)
-    raise Exception("Network connection failed: " + str(wlan_status))
+# The PIO backend is hardware timed, only the CPU replay can drift
+ir_timing = None
+if IR_TIMING_PROBE:
+    # Follows TIMINGS, errors are against what the backend was asked for
+    ir_timing = TimingProbe(daikinremote.SYMBOL_NAMES, daikinremote.TIMINGS)
 
+memory = MemoryProbe()
 
-def blink_led(times):
-    for i in range(times):
-        led.value(1)
-        time.sleep_ms(250)
-        led.value(0)
-        time.sleep_ms(250)
+
+def flash_write_deferred(timer):
+    # A flash write locks core1 out, stalling an IR send in progress. Returns
+    # True if one is, timer is then started to try again later.
+    for unit in units:
+        if unit.channel.busy():
+            loop.start(timer, FLASH_WRITE_RETRY_MS)
+            return True
+    return False
 
 
-def save_state():
-    global CURRENT_STATE
+def state_temperature(state):
+    # Temperature as an int, without parsing through float
+    return MIN_TEMP + TEMPERATURES.index(state["temperature"])
 
-    # Save state to JSON encoded file
-    with open("state.json", "w") as f:
-        json.dump(CURRENT_STATE, f)
 
-    print("Saved state: " + str(CURRENT_STATE))
+def pack_state(state):
+    # power (1 bit), mode (3 bits), fan mode (3 bits), temperature (7 bits)
+    return (
+        (1 if state["power"] == "on" else 0)
+        | MODES.index(state["mode"]) << 1
+        | FAN_MODES.index(state["fan_mode"]) << 4
+        | state_temperature(state) << 8
+    )
 
 
-def load_state():
-    # Load state from JSON encoded file, check if file exists before.
-    global CURRENT_STATE
+def unpack_state(packed, state):
+    mode = packed >> 1 & 0x7
+    fan_mode = packed >> 4 & 0x7
+    temperature = packed >> 8 & 0x7F
+    if (
+        mode >= len(MODES)
+        or fan_mode >= len(FAN_MODES)
+        or temperature < MIN_TEMP
+        or temperature > MAX_TEMP
+    ):
+        return False
+
+    state["power"] = "on" if packed & 0x1 else "off"
+    state["mode"] = MODES[mode]
+    state["fan_mode"] = FAN_MODES[fan_mode]
+    state["temperature"] = "{0}.0".format(temperature)
+    return True
 
+
+def load_legacy_state(state):
+    # JSON encoded file used by previous versions
     try:
         with open("state.json", "r") as f:
             loaded_state = json.load(f)
@@ -134,60 +342,977 @@ def load_state():
             # Check if loaded state is valid
             if loaded_state["power"] not in ["on", "off"]:
                 loaded_state["power"] = DEFAULT_STATE["power"]
-            CURRENT_STATE["power"] = loaded_state["power"]
+            state["power"] = loaded_state["power"]
 
             if loaded_state["mode"] not in MODES:
                 loaded_state["mode"] = DEFAULT_STATE["mode"]
-            CURRENT_STATE["mode"] = loaded_state["mode"]
+            state["mode"] = loaded_state["mode"]
 
             if loaded_state["fan_mode"] not in FAN_MODES:
                 loaded_state["fan_mode"] = DEFAULT_STATE["fan_mode"]
-            CURRENT_STATE["fan_mode"] = loaded_state["fan_mode"]
+            state["fan_mode"] = loaded_state["fan_mode"]
 
-            if (
-                int(float(loaded_state["temperature"])) < MIN_TEMP
-                or int(float(loaded_state["temperature"])) > MAX_TEMP
-            ):
-                loaded_state["temperature"] = DEFAULT_STATE["temperature"]
-            CURRENT_STATE["temperature"] = loaded_state["temperature"]
+            temperature = int(float(loaded_state["temperature"]))
+            if temperature < MIN_TEMP or temperature > MAX_TEMP:
+                state["temperature"] = DEFAULT_STATE["temperature"]
+            else:
+                state["temperature"] = TEMPERATURES[temperature - MIN_TEMP]
 
-            print("Loaded state: " + str(CURRENT_STATE))
+            print("Loaded state: " + str(state))
     except Exception as e:
         print("Error while loading state, resetting to default: " + str(e))
         # Copy default state values into the current state
-        CURRENT_STATE["power"] = DEFAULT_STATE["power"]
-        CURRENT_STATE["mode"] = DEFAULT_STATE["mode"]
-        CURRENT_STATE["fan_mode"] = DEFAULT_STATE["fan_mode"]
-        CURRENT_STATE["temperature"] = DEFAULT_STATE["temperature"]
+        state["power"] = DEFAULT_STATE["power"]
+        state["mode"] = DEFAULT_STATE["mode"]
+        state["fan_mode"] = DEFAULT_STATE["fan_mode"]
+        state["temperature"] = DEFAULT_STATE["temperature"]
 
 
-def start_mqtt_client():
-    print("Starting MQTT client...")
+class ClimateUnit:
+    """One indoor unit: its IR channel, state, journal and MQTT topics.
 
-    c.connect()
+    The first unit keeps the board's ids, topics and state file, so a single
+    unit setup is unchanged.
+    """
+
+    def __init__(self, index, name, backend):
+        self.index = index
+        self.name = name
+        if index == 0:
+            self.unique_id = UNIQUE_ID
+            journal_path = "state.bin"
+        else:
+            self.unique_id = "{0}_{1}".format(UNIQUE_ID, index)
+            journal_path = "state{0}.bin".format(index)
+
+        self.channel = daikinremote.add_channel(backend)
+        self.journal = StateJournal(journal_path)
+        self.state = {}
+
+        # Bitmask of state_fields to send, then to confirm once the unit has them
+        self.pending_fields = 0
+        self.pending_since = None
+        self.confirm_fields = 0
+
+        # pack_state() of the last state handed to the IR channel, -1 when
+        # unknown (its transmission failed), and the last published values
+        self.sent_state = -1
+        self.published_values = [None, None, None]
+        # JSON_STATE: pack_state() of the last published state, the JSON is
+        # serialized in state_buffer and published through a view per length
+        self.published_state = -1
+        self.state_buffer = bytearray(STATE_JSON_SIZE)
+        self.state_views = {}
+        # Set by the resend command: transmit even if nothing changed
+        self.force_resend = False
+
+        # Created once, commands don't allocate timers or bound methods
+        self.flush_timer = loop.timer(self.flush_pending_state)
+        self.save_timer = loop.timer(self.write_state)
+        self.state_sent_callback = self.state_sent
+
+        self.fan_mode_command_topic = self.topic("fan_mode/set")
+        self.fan_mode_state_topic = self.topic("fan_mode")
+        self.mode_command_topic = self.topic("mode/set")
+        self.mode_state_topic = self.topic("mode")
+        self.temperature_command_topic = self.topic("temperature/set")
+        self.temperature_state_topic = self.topic("temperature")
+        self.resend_command_topic = self.topic("resend/set")
+        self.state_topic = self.topic("state")
+        self.state_command_topic = self.topic("state/set")
+        self.command_topics = (
+            self.fan_mode_command_topic,
+            self.mode_command_topic,
+            self.temperature_command_topic,
+            self.resend_command_topic,
+            self.state_command_topic,
+        )
+        self.state_fields = (
+            ("fan_mode", self.fan_mode_state_topic),
+            ("mode", self.mode_state_topic),
+            ("temperature", self.temperature_state_topic),
+        )
+
+        self.discovery_topic = "homeassistant/climate/{0}/config".format(
+            self.unique_id
+        ).encode("utf-8")
+        self.resend_discovery_topic = "homeassistant/button/{0}_resend/config".format(
+            self.unique_id
+        ).encode("utf-8")
+
+    def topic(self, topic):
+        return get_full_topic(topic, self.unique_id)
+
+    def hass_availability(self):
+        # Relative to "~" when the unit has the board's topics
+        if self.index == 0:
+            return "~/availability"
+        return MQTT_AVAILABILITY_TOPIC
+
+    def get_hass_device(self):
+        device = {
+            "~": "{0}/{1}".format(VENDOR, self.unique_id),
+            "uniq_id": self.unique_id,
+            "name": "Daikin IR Remote",
+            "fan_mode_cmd_t": "~/fan_mode/set",
+            "fan_mode_stat_t": "~/fan_mode",
+            "fan_modes": FAN_MODES,
+            "mode_cmd_t": "~/mode/set",
+            "mode_stat_t": "~/mode",
+            "modes": MODES,
+            "max_temp": MAX_TEMP,
+            "min_temp": MIN_TEMP,
+            "precision": 1,
+            "temp_cmd_t": "~/temperature/set",
+            "temp_stat_t": "~/temperature",
+            "temp_unit": "C",
+            "avty_t": self.hass_availability(),
+            "dev": {
+                "ids": [self.unique_id],
+                "name": self.name,
+                "mdl": "pico-daikin-remote",
+                "mf": "glavoie84",
+            },
+        }
+        if JSON_STATE:
+            for field, key in (
+                ("fan_mode", "fan_mode"),
+                ("mode", "mode"),
+                ("temperature", "temp"),
+            ):
+                device[key + "_stat_t"] = "~/state"
+                device[key + "_stat_tpl"] = "{{ value_json." + field + " }}"
+        return device
+
+    def get_hass_resend_button(self):
+        # For when the unit was changed with its own remote
+        return {
+            "~": "{0}/{1}".format(VENDOR, self.unique_id),
+            "uniq_id": "{0}_resend".format(self.unique_id),
+            "name": "Resend state",
+            "cmd_t": "~/resend/set",
+            "ent_cat": "config",
+            "avty_t": self.hass_availability(),
+            "dev": {"ids": [self.unique_id]},
+        }
+
+    def load_state(self):
+        packed = self.journal.load()
+        if packed is not None and unpack_state(packed, self.state):
+            print("Loaded state: {0} ({1} us)".format(self.state, self.journal.load_us))
+            # Only states the unit received are saved
+            self.sent_state = packed
+            return
+
+        if self.index == 0:
+            load_legacy_state(self.state)
+        else:
+            self.state.update(DEFAULT_STATE)
+
+    def save_state(self):
+        # Writes are deferred, a burst of changes ends up in a single record
+        if self.journal.save(pack_state(self.state)):
+            loop.start(self.save_timer, STATE_WRITE_DELAY_MS)
+
+    def write_state(self):
+        if not flash_write_deferred(self.save_timer):
+            self.flush_state()
+
+    def flush_state(self):
+        if self.journal.flush():
+            print("Saved state: " + str(self.state))
+
+    def encode_state(self):
+        # Returns the state as JSON, serialized in state_buffer
+        state = self.state
+        buf = self.state_buffer
+        n = put_bytes(buf, 0, _JSON_POWER)
+        n = put_bytes(buf, n, ENCODED_VALUES[state["power"]])
+        n = put_bytes(buf, n, _JSON_MODE)
+        n = put_bytes(buf, n, ENCODED_VALUES[state["mode"]])
+        n = put_bytes(buf, n, _JSON_FAN_MODE)
+        n = put_bytes(buf, n, ENCODED_VALUES[state["fan_mode"]])
+        n = put_bytes(buf, n, _JSON_TEMPERATURE)
+        n = put_bytes(buf, n, ENCODED_VALUES[state["temperature"]])
+        n = put_bytes(buf, n, _JSON_END)
+
+        # Only a few lengths are possible, their views are kept
+        view = self.state_views.get(n)
+        if view is None:
+            view = memoryview(buf)[:n]
+            self.state_views[n] = view
+        return view
+
+    def publish_state(self):
+        if JSON_STATE:
+            c.publish(self.state_topic, self.encode_state(), True)
+            self.published_state = pack_state(self.state)
+            return
+
+        state = self.state
+        fan_mode = ENCODED_VALUES[state["fan_mode"]]
+        mode = ENCODED_VALUES[state["mode"]]
+        temperature = ENCODED_VALUES[state["temperature"]]
+        c.publish(self.fan_mode_state_topic, fan_mode, True)
+        c.publish(self.fan_mode_command_topic, fan_mode)
+        c.publish(self.mode_state_topic, mode, True)
+        c.publish(self.mode_command_topic, mode)
+        c.publish(self.temperature_state_topic, temperature, True)
+        c.publish(self.temperature_command_topic, temperature)
+
+        published = self.published_values
+        published[0] = state["fan_mode"]
+        published[1] = state["mode"]
+        published[2] = state["temperature"]
+
+    def add_command_handlers(self):
+        # Once per unit, sessions only subscribe to command_topics again
+        COMMAND_HANDLERS.add(self.fan_mode_command_topic, self.set_fan_mode)
+        COMMAND_HANDLERS.add(self.mode_command_topic, self.set_mode)
+        COMMAND_HANDLERS.add(self.temperature_command_topic, self.set_temperature)
+        COMMAND_HANDLERS.add(self.resend_command_topic, self.resend)
+        COMMAND_HANDLERS.add(self.state_command_topic, self.set_state)
+
+    # Command handlers update the state and mark the changed field as pending,
+    # a value equal to the current one is dropped
+
+    def set_fan_mode(self, msg):
+        global COMMANDS_UNCHANGED
+
+        fan_mode = match_value(msg, FAN_MODE_VALUES, FAN_MODES)
+        if fan_mode is None:
+            print("Invalid fan mode: " + str(bytes(msg)))
+            return
+
+        if fan_mode == self.state["fan_mode"]:
+            COMMANDS_UNCHANGED += 1
+            return
+
+        self.state["fan_mode"] = fan_mode
+        self.changed(_FAN_MODE_FIELD)
 
+    def set_mode(self, msg):
+        global COMMANDS_UNCHANGED
+
+        mode = match_value(msg, MODE_VALUES, MODES)
+        if mode is None:
+            print("Invalid mode: " + str(bytes(msg)))
+            return
+
+        if mode == self.state["mode"]:
+            COMMANDS_UNCHANGED += 1
+            return
+
+        self.state["mode"] = mode
+        if mode == "off":
+            self.state["power"] = "off"
+        else:
+            self.state["power"] = "on"
+        self.changed(_MODE_FIELD)
+
+    def set_temperature(self, msg):
+        global COMMANDS_UNCHANGED
+
+        temperature = parse_int(msg)
+        if temperature < MIN_TEMP or temperature > MAX_TEMP:
+            print("Invalid temperature: " + str(bytes(msg)))
+            return
+
+        temperature = TEMPERATURES[temperature - MIN_TEMP]
+        if temperature == self.state["temperature"]:
+            COMMANDS_UNCHANGED += 1
+            return
+
+        self.state["temperature"] = temperature
+        self.changed(_TEMPERATURE_FIELD)
+
+    def set_state(self, msg):
+        # A whole state in one message, {"power": ..., "mode": ..., "fan_mode":
+        # ..., "temperature": ...}. Fields left out are kept, the changes go
+        # out in a single transmission.
+        global COMMANDS_UNCHANGED
+
+        state = self.state
+        try:
+            payload = json.loads(bytes(msg))
+            power = payload.get("power")
+            mode = payload.get("mode", state["mode"])
+            fan_mode = payload.get("fan_mode", state["fan_mode"])
+            # Numbers or strings, parsed like temperature/set payloads
+            temperature = payload.get("temperature")
+            if temperature is None:
+                temperature = state_temperature(state)
+            else:
+                temperature = parse_int(str(temperature).encode())
+        except (ValueError, TypeError, AttributeError):
+            power = mode = fan_mode = temperature = None
+
+        if power == "off":
+            mode = "off"
+        if (
+            power not in (None, "on", "off")
+            or mode not in MODES
+            or (power == "on" and mode == "off")
+            or fan_mode not in FAN_MODES
+            or temperature is None
+            or temperature < MIN_TEMP
+            or temperature > MAX_TEMP
+        ):
+            print("Invalid state: " + str(bytes(msg)))
+            return
+
+        fields = 0
+        if mode != state["mode"]:
+            state["mode"] = mode
+            state["power"] = "off" if mode == "off" else "on"
+            fields |= _MODE_FIELD
+        if fan_mode != state["fan_mode"]:
+            state["fan_mode"] = fan_mode
+            fields |= _FAN_MODE_FIELD
+        temperature = TEMPERATURES[temperature - MIN_TEMP]
+        if temperature != state["temperature"]:
+            state["temperature"] = temperature
+            fields |= _TEMPERATURE_FIELD
+
+        if not fields:
+            COMMANDS_UNCHANGED += 1
+            return
+        self.changed(fields)
+
+    def resend(self, msg):
+        # Any payload: the current state goes out even if the unit should have it
+        self.force_resend = True
+        self.changed(0)
+
+    def changed(self, field):
+        global COMMANDS_MERGED
+
+        self.pending_fields |= field
+
+        # The first command of a burst opens the window, the others join it
+        if self.pending_since is None:
+            self.pending_since = time.ticks_us()
+            loop.start(self.flush_timer, COALESCE_MS)
+        else:
+            COMMANDS_MERGED += 1
+
+    def flush_pending_state(self):
+        if self.pending_since is None:
+            return
+
+        global BLASTS_SUPPRESSED
+
+        since = self.pending_since
+        fields = self.pending_fields
+        self.pending_fields = 0
+        self.pending_since = None
+
+        # A burst can end where it started, or a resend find nothing to do
+        packed = pack_state(self.state)
+        if packed == self.sent_state and not self.force_resend:
+            BLASTS_SUPPRESSED += 1
+            return
+
+        self.force_resend = False
+        self.sent_state = packed
+        self.confirm_fields |= fields
+
+        memory.commands += 1
+        memory.mark()
+        state = self.state
+        self.channel.send_async(
+            state["power"],
+            state["mode"],
+            state_temperature(state),
+            state["fan_mode"],
+            self.state_sent_callback,
+        )
+        memory.count()
+
+        record_latency(self.channel, since)
+
+    def state_sent(self, error):
+        if error is not None:
+            print("Error while sending state through IR: " + str(error))
+            # The unit may have anything now, the next state goes out for sure
+            self.sent_state = -1
+            return
+
+        if self.channel.busy():
+            # A newer state is on its way, its completion confirms everything
+            return
+
+        memory.mark()
+        self.save_state()
+
+        # Only confirm the new state once the unit actually received it,
+        # at QoS 1 so a dropped confirmation is sent again. Offline, the
+        # whole state is published when the session is back.
+        fields = self.confirm_fields
+        self.confirm_fields = 0
+        if ONLINE:
+            try:
+                c.begin_batch()
+                if JSON_STATE:
+                    self.publish_json_state()
+                else:
+                    self.publish_fields(fields)
+                if ir_timing is not None:
+                    c.publish(
+                        MQTT_IR_TIMING_TOPIC, json.dumps(ir_timing.summary()), True
+                    )
+                c.flush()
+            except OSError as e:
+                go_offline("MQTT error: " + str(e))
+
+        memory.count()
+        memory.sample()
+
+    def publish_json_state(self):
+        global PUBLISHES_SUPPRESSED
+
+        packed = pack_state(self.state)
+        if packed == self.published_state:
+            PUBLISHES_SUPPRESSED += 1
+            return
+        c.publish(self.state_topic, self.encode_state(), True, 1)
+        self.published_state = packed
+
+    def publish_fields(self, fields):
+        global PUBLISHES_SUPPRESSED
+
+        published = self.published_values
+        for i in range(len(self.state_fields)):
+            if fields & 1 << i:
+                field, state_topic = self.state_fields[i]
+                value = self.state[field]
+                if value == published[i]:
+                    PUBLISHES_SUPPRESSED += 1
+                    continue
+                c.publish(state_topic, ENCODED_VALUES[value], True, 1)
+                published[i] = value
+
+
+def create_units():
+    units = []
+    for i in range(len(UNITS)):
+        config = UNITS[i]
+        if ir_timing is not None:
+            # CPU replay: units take turns, see daikinremote.Channel
+            backend = PWMBackend(config["pin"], ir_timing)
+        else:
+            backend = PIOBackend(config["pin"], config.get("sm", i))
+        unit = ClimateUnit(i, config.get("name", NAME), backend)
+        unit.add_command_handlers()
+        units.append(unit)
+    return units
+
+
+units = create_units()
+
+
+def local_minute():
+    return epoch_minute() + UTC_OFFSET_MINUTES
+
+
+def schedule_action(entry):
+    # unit (3 bits), mode + 1 (3 bits), fan mode + 1 (3 bits), temperature
+    # (6 bits). A 0 leaves the setting as it is.
+    unit = entry.get("unit", 0)
+    if unit < 0 or unit >= len(units):
+        raise ValueError("unknown unit " + str(unit))
+
+    action = unit
+    if "mode" in entry:
+        action |= (MODES.index(entry["mode"]) + 1) << 3
+    if "fan_mode" in entry:
+        action |= (FAN_MODES.index(entry["fan_mode"]) + 1) << 6
+    if "temperature" in entry:
+        temperature = int(entry["temperature"])
+        if temperature < MIN_TEMP or temperature > MAX_TEMP:
+            raise ValueError("invalid temperature " + str(temperature))
+        action |= temperature << 9
+    return action
+
+
+def parse_schedule(schedule, now):
+    # Returns (minute, action, weekly) entries, raises on an invalid one.
+    # Weekly entries are minutes of the week, one-shots local epoch minutes:
+    # a one-shot given "in" minutes gets its "due" minute from now.
+    entries = []
+    for entry in schedule.get("weekly", ()):
+        hours, minutes = entry["at"].split(":")
+        at = int(hours) * 60 + int(minutes)
+        if at < 0 or at >= MINUTES_PER_DAY:
+            raise ValueError("invalid time " + entry["at"])
+        action = schedule_action(entry)
+        for day in entry["days"]:
+            entries.append((DAYS.index(day) * MINUTES_PER_DAY + at, action, True))
+
+    for entry in schedule.get("once", ()):
+        if "in" in entry:
+            if now is None:
+                raise ValueError("clock not set")
+            entry["due"] = now + int(entry.pop("in"))
+        due = int(entry["due"])
+        if now is not None and due - now > MAX_DELAY:
+            raise ValueError("one-shot too far ahead")
+        entries.append((due, schedule_action(entry), False))
+
+    if len(entries) > scheduler.capacity:
+        raise ValueError("too many entries")
+    return entries
+
+
+def drop_one_shots(now):
+    # Removes the one-shots that fired or can't be placed on the wheel from
+    # the schedule, returns True if there were any
+    global SCHEDULE_ENTRIES
+
+    entries = [
+        entry
+        for entry in SCHEDULE_ENTRIES
+        if entry[2] or now < entry[0] <= now + MAX_DELAY
+    ]
+    if len(entries) == len(SCHEDULE_ENTRIES):
+        return False
+
+    SCHEDULE_ENTRIES = entries
+    SCHEDULE["once"] = [
+        entry
+        for entry in SCHEDULE.get("once", ())
+        if now < int(entry["due"]) <= now + MAX_DELAY
+    ]
+    return True
+
+
+def apply_schedule():
+    # Rebuilds the wheel, for a new schedule or when the clock was set.
+    # Returns True if one-shots were dropped and the schedule needs saving.
+    scheduler.clear()
+    if not CLOCK_SYNCED:
+        return False
+
+    # From the last minute the tick processed when that's the one before,
+    # so entries due this minute still fire with the next tick
+    now = local_minute()
+    start = now
+    if scheduler.minute >= 0 and now - scheduler.minute == 1:
+        start = scheduler.minute
+    dropped = drop_one_shots(start)
+    scheduler.start(start)
+    for minute, action, weekly in SCHEDULE_ENTRIES:
+        if weekly:
+            scheduler.add_weekly(minute, action)
+        else:
+            scheduler.add_once(minute, action)
+    return dropped
+
+
+def save_schedule():
+    if flash_write_deferred(schedule_save_timer):
+        return
+    with open(SCHEDULE_PATH, "w") as f:
+        json.dump(SCHEDULE, f)
+
+
+schedule_save_timer = loop.timer(save_schedule)
+
+
+def load_schedule():
+    global SCHEDULE, SCHEDULE_ENTRIES
+
+    try:
+        with open(SCHEDULE_PATH, "r") as f:
+            schedule = json.load(f)
+    except OSError:
+        return
+
+    try:
+        SCHEDULE_ENTRIES = parse_schedule(schedule, None)
+        SCHEDULE = schedule
+        print("Loaded schedule: {0} entries".format(len(SCHEDULE_ENTRIES)))
+    except (ValueError, KeyError, TypeError, OverflowError) as e:
+        print("Error while loading schedule: " + str(e))
+
+
+def set_schedule(msg):
+    # {"weekly": [{"days": ["mon", ...], "at": "HH:MM", "unit": 0, "mode": ...,
+    # "fan_mode": ..., "temperature": ...}], "once": [{"in": minutes, ...}]}
+    # replaces the whole schedule. Settings left out are not changed.
+    global SCHEDULE, SCHEDULE_ENTRIES
+
+    try:
+        schedule = json.loads(bytes(msg))
+        entries = parse_schedule(schedule, local_minute() if CLOCK_SYNCED else None)
+    except (ValueError, KeyError, TypeError, AttributeError, OverflowError) as e:
+        print("Invalid schedule: " + str(e))
+        return
+
+    # Only saved once the wheel took it, the previous schedule stays otherwise
+    previous = SCHEDULE, SCHEDULE_ENTRIES
+    SCHEDULE = schedule
+    SCHEDULE_ENTRIES = entries
+    try:
+        apply_schedule()
+    except ValueError as e:
+        print("Invalid schedule: " + str(e))
+        SCHEDULE, SCHEDULE_ENTRIES = previous
+        apply_schedule()
+        return
+    save_schedule()
+    print("Schedule set: {0} entries".format(len(SCHEDULE_ENTRIES)))
+
+    if ONLINE:
+        try:
+            c.publish(MQTT_SCHEDULE_TOPIC, json.dumps(SCHEDULE), True)
+        except OSError as e:
+            go_offline("MQTT error: " + str(e))
+
+
+def run_action(action):
+    # Goes through the command handlers, like a command from MQTT
+    unit = units[action & 0x7]
+    mode = action >> 3 & 0x7
+    fan_mode = action >> 6 & 0x7
+    temperature = action >> 9 & 0x3F
+    if mode:
+        unit.set_mode(MODE_VALUES[mode - 1])
+    if fan_mode:
+        unit.set_fan_mode(FAN_MODE_VALUES[fan_mode - 1])
+    if temperature:
+        unit.set_temperature(ENCODED_VALUES[TEMPERATURES[temperature - MIN_TEMP]])
+
+
+def tick_schedule():
+    if not CLOCK_SYNCED:
+        return
+
+    now = local_minute()
+    if now == scheduler.minute:
+        return
+
+    # Frame 2 carries the clock, Sunday is day 1
+    week_minute = minute_of_week(now)
+    daikinremote.set_clock(
+        week_minute % MINUTES_PER_DAY, (week_minute // MINUTES_PER_DAY + 1) % 7 + 1
+    )
+    scheduler.tick(now)
+    if drop_one_shots(now):
+        save_schedule()
+
+
+scheduler = Scheduler(run_action)
+COMMAND_HANDLERS.add(MQTT_SCHEDULE_COMMAND_TOPIC, set_schedule)
+
+
+def get_hass_ir_timing_sensor():
+    return {
+        "~": "{0}/{1}".format(VENDOR, UNIQUE_ID),
+        "uniq_id": "{0}_ir_timing".format(UNIQUE_ID),
+        "name": "IR timing error p99",
+        "stat_t": "~/diagnostics/ir_timing",
+        "val_tpl": "{{ value_json.p99 }}",
+        "json_attr_t": "~/diagnostics/ir_timing",
+        "unit_of_meas": "us",
+        "ent_cat": "diagnostic",
+        "avty_t": "~/availability",
+        "dev": {"ids": [UNIQUE_ID]},
+    }
+
+
+def boot_phase(name):
+    # Ends the current boot phase, nothing is recorded once ready
+    global _phase_start
+
+    if BOOT_READY_MS:
+        return
+
+    now = time.ticks_ms()
+    BOOT_PHASES.append((name, time.ticks_diff(now, _phase_start)))
+    _phase_start = now
+
+
+def boot_ready():
+    global BOOT_READY_MS
+
+    boot_phase("subscribe")
+    BOOT_READY_MS = time.ticks_ms()
     print(
-        "Publishing device discovery message to MQTT: {0}".format(MQTT_DISCOVERY_TOPIC)
+        "Ready {0} ms after reset: {1}".format(
+            BOOT_READY_MS,
+            ", ".join("{0} {1} ms".format(name, ms) for name, ms in BOOT_PHASES),
+        )
     )
-    c.publish(MQTT_DISCOVERY_TOPIC, json.dumps(get_hass_device()), True)
 
-    time.sleep(1)
+    report = {
+        "ready_ms": BOOT_READY_MS,
+        "mqtt_ready_ms": MQTT_READY_MS,
+        "discovery_bytes": DISCOVERY_BYTES,
+        "discovery_build_us": DISCOVERY_BUILD_US,
+        "discovery_publishes": DISCOVERY_PUBLISHES,
+    }
+    for name, ms in BOOT_PHASES:
+        report[name] = ms
+    c.publish(MQTT_BOOT_TOPIC, json.dumps(report), True)
+
+
+def load_network_cache():
+    try:
+        with open(NETWORK_CACHE_PATH, "r") as f:
+            cache = json.load(f)
+        if cache["ssid"] == SSID:
+            return cache
+    except Exception:
+        pass
+
+    return None
+
+
+def save_network_cache():
+    # Remembers the strongest access point of our SSID, a scan takes a
+    # couple of seconds so it only runs when the cache is missing or stale
+    global NETWORK_CACHE
+
+    best = None
+    for ssid, bssid, channel, rssi, _, _ in wlan.scan():
+        if ssid.decode("utf-8") == SSID and (best is None or rssi > best[2]):
+            best = (bssid, channel, rssi)
+
+    if best is None:
+        return
+
+    NETWORK_CACHE = {
+        "ssid": SSID,
+        "bssid": ubinascii.hexlify(best[0]).decode("utf-8"),
+        "channel": best[1],
+    }
+    write_network_cache()
+
+
+def write_network_cache():
+    if flash_write_deferred(network_cache_timer):
+        return
+    with open(NETWORK_CACHE_PATH, "w") as f:
+        json.dump(NETWORK_CACHE, f)
+    print(
+        "Cached access point {0} on channel {1}".format(
+            NETWORK_CACHE["bssid"], NETWORK_CACHE["channel"]
+        )
+    )
+
+
+network_cache_timer = loop.timer(write_network_cache)
+
+
+def wait_for_network(timeout_ms):
+    # Polls the link every few ms, the association and DHCP phases end as
+    # soon as the status moves on
+    start = time.ticks_ms()
+    associated = False
+    while time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+        status = wlan.status()
+        if status < 0 or status >= network.STAT_GOT_IP:
+            break
+        if not associated and status == _LINK_NOIP:
+            associated = True
+            boot_phase("associate")
+        time.sleep_ms(5)
+
+    status = wlan.status()
+    if status == network.STAT_GOT_IP:
+        if not associated:
+            boot_phase("associate")
+        boot_phase("dhcp")
+    return status
+
+
+def get_hass_memory_sensor():
+    return {
+        "~": "{0}/{1}".format(VENDOR, UNIQUE_ID),
+        "uniq_id": "{0}_memory".format(UNIQUE_ID),
+        "name": "Free memory low-water mark",
+        "stat_t": "~/diagnostics/memory",
+        "val_tpl": "{{ value_json.free_min }}",
+        "json_attr_t": "~/diagnostics/memory",
+        "unit_of_meas": "B",
+        "ent_cat": "diagnostic",
+        "avty_t": "~/availability",
+        "dev": {"ids": [UNIQUE_ID]},
+    }
+
+
+def connect_to_network():
+    global NETWORK_CACHE
+
+    print("Connecting to Network (timeout 10 seconds)...")
+    wlan.active(True)
+    if STATIC_IP is not None:
+        wlan.ifconfig(STATIC_IP)
+
+    NETWORK_CACHE = load_network_cache()
+    status = -1
+    if NETWORK_CACHE is not None:
+        # Join the known access point directly instead of scanning for it
+        wlan.connect(SSID, PASSWORD, bssid=ubinascii.unhexlify(NETWORK_CACHE["bssid"]))
+        status = wait_for_network(NETWORK_TIMEOUT_MS // 2)
+        if status != network.STAT_GOT_IP:
+            print("Cached access point unreachable: " + str(status))
+            NETWORK_CACHE = None
+            wlan.disconnect()
+
+    if NETWORK_CACHE is None:
+        wlan.connect(SSID, PASSWORD)
+        status = wait_for_network(NETWORK_TIMEOUT_MS)
+
+    # Handle connection error
+    if status != network.STAT_GOT_IP:
+        blink_led(3)
+        print("Network connection failed: " + str(status))
+        return False
+
+    blink_led(2)
+
+    status = wlan.ifconfig()
+    print("Network online! IP: " + status[0])
+    return True
+
+
+def _led_tick(timer):
+    global _led_toggles
+
+    led.toggle()
+    _led_toggles -= 1
+    if _led_toggles <= 0:
+        timer.deinit()
+
+
+def blink_led(times):
+    # Blinks from a timer, returns right away
+    global _led_toggles
+
+    led.value(1)
+    _led_toggles = times * 2 - 1
+    led_timer.init(mode=Timer.PERIODIC, period=250, callback=_led_tick)
+
+
+def load_state():
+    for unit in units:
+        unit.load_state()
+
+
+def flush_state():
+    for unit in units:
+        unit.flush_state()
+
+
+def start_mqtt_client():
+    global MQTT_READY_MS
+
+    print("Starting MQTT client...")
+    start = time.ticks_ms()
 
-    print("Publishing current state to MQTT topics...")
-    c.publish(MQTT_FAN_MODE_STATE_TOPIC, CURRENT_STATE["fan_mode"], True)
-    c.publish(MQTT_FAN_MODE_COMMAND_TOPIC, CURRENT_STATE["fan_mode"])
-    c.publish(MQTT_MODE_STATE_TOPIC, CURRENT_STATE["mode"], True)
-    c.publish(MQTT_MODE_COMMAND_TOPIC, CURRENT_STATE["mode"])
-    c.publish(MQTT_TEMPERATURE_STATE_TOPIC, CURRENT_STATE["temperature"], True)
-    c.publish(MQTT_TEMPERATURE_COMMAND_TOPIC, CURRENT_STATE["temperature"])
-
-    print("Subscribing to MQTT topics...")
     c.set_callback(process_message)
-    c.subscribe(MQTT_FAN_MODE_COMMAND_TOPIC)
-    c.subscribe(MQTT_MODE_COMMAND_TOPIC)
-    c.subscribe(MQTT_TEMPERATURE_COMMAND_TOPIC)
+    c.connect()
+    boot_phase("connect")
+
+    # Home Assistant has to know the entities before their state arrives:
+    # discovery goes first at QoS 1, the rest once it is acknowledged.
+    if DISCOVERY_HASH != _published_discovery_hash:
+        publish_discovery()
+        c.wait_acks()
+        save_discovery_hash()
+    boot_phase("discovery")
+
+    print("Publishing current state to MQTT topics...")
+    publish_session()
+
+    MQTT_READY_MS = time.ticks_diff(time.ticks_ms(), start)
+    print("MQTT client started in {0} ms!".format(MQTT_READY_MS))
+
+
+def publish_session():
+    # Everything a fresh session needs: the broker kept neither the
+    # subscriptions nor the state published while it was gone
+    c.begin_batch()
+    c.publish(MQTT_AVAILABILITY_TOPIC, "online", True)
+    for unit in units:
+        unit.publish_state()
+    c.publish(MQTT_SCHEDULE_TOPIC, json.dumps(SCHEDULE), True)
+
+    # A single SUBSCRIBE for every command topic, sent with the batch
+    topics = [HASS_STATUS_TOPIC, MQTT_SCHEDULE_COMMAND_TOPIC]
+    if IR_RECEIVER_PIN is not None:
+        topics.append(MQTT_CALIBRATE_COMMAND_TOPIC)
+    for unit in units:
+        topics.extend(unit.command_topics)
+    c.subscribe(topics)
+
+
+def build_discovery():
+    global DISCOVERY, DISCOVERY_BYTES, DISCOVERY_BUILD_US, DISCOVERY_HASH
+    global _published_discovery_hash
+
+    start = time.ticks_us()
+    messages = []
+    for unit in units:
+        messages.append((unit.discovery_topic, unit.get_hass_device()))
+        messages.append((unit.resend_discovery_topic, unit.get_hass_resend_button()))
+    if ir_timing is not None:
+        messages.append((MQTT_IR_TIMING_DISCOVERY_TOPIC, get_hass_ir_timing_sensor()))
+    messages.append((MQTT_MEMORY_DISCOVERY_TOPIC, get_hass_memory_sensor()))
+
+    DISCOVERY = []
+    DISCOVERY_BYTES = 0
+    DISCOVERY_HASH = 0
+    for topic, config in messages:
+        payload = json.dumps(config).encode("utf-8")
+        DISCOVERY.append((topic, payload))
+        DISCOVERY_BYTES += len(payload)
+        DISCOVERY_HASH = ubinascii.crc32(topic, DISCOVERY_HASH)
+        DISCOVERY_HASH = ubinascii.crc32(payload, DISCOVERY_HASH)
+    DISCOVERY_BUILD_US = time.ticks_diff(time.ticks_us(), start)
+
+    try:
+        with open(DISCOVERY_HASH_PATH, "r") as f:
+            _published_discovery_hash = json.load(f)["hash"]
+    except Exception:
+        _published_discovery_hash = None
+
+
+def save_discovery_hash():
+    global _published_discovery_hash
+
+    _published_discovery_hash = DISCOVERY_HASH
+    write_discovery_hash()
+
+
+def write_discovery_hash():
+    if flash_write_deferred(discovery_hash_timer):
+        return
+    with open(DISCOVERY_HASH_PATH, "w") as f:
+        json.dump({"hash": _published_discovery_hash}, f)
+
+
+discovery_hash_timer = loop.timer(write_discovery_hash)
 
-    print("MQTT client started!")
+
+def publish_discovery():
+    global DISCOVERY_PUBLISHES
+
+    print("Publishing discovery messages to MQTT ({0} bytes)".format(DISCOVERY_BYTES))
+    for topic, payload in DISCOVERY:
+        c.publish(topic, payload, True, 1)
+    DISCOVERY_PUBLISHES += 1
+
+
+def hass_status(msg):
+    # Home Assistant restarted, it may have lost the retained discovery
+    if buffer_equal(msg, b"online"):
+        publish_discovery()
+
+
+COMMAND_HANDLERS.add(HASS_STATUS_TOPIC, hass_status)
 
 
 def close_mqtt_client():
@@ -196,65 +1321,344 @@ def close_mqtt_client():
 
 
 def process_message(topic, msg):
-    global CURRENT_STATE
+    handler = COMMAND_HANDLERS.lookup(topic)
+    if handler is None:
+        print("Unknown topic: " + str(bytes(topic)))
+        return
 
-    print("Received message: " + str(topic) + " " + str(msg))
+    memory.mark()
+    handler(msg)
+    memory.count()
 
-    if topic == MQTT_FAN_MODE_COMMAND_TOPIC:
-        CURRENT_STATE["fan_mode"] = msg.decode("utf-8")
-        c.publish(MQTT_FAN_MODE_STATE_TOPIC, msg, True)
-    elif topic == MQTT_MODE_COMMAND_TOPIC:
-        CURRENT_STATE["mode"] = msg.decode("utf-8")
-        c.publish(MQTT_MODE_STATE_TOPIC, msg, True)
 
-        if CURRENT_STATE["mode"] == "off":
-            CURRENT_STATE["power"] = "off"
-        else:
-            CURRENT_STATE["power"] = "on"
-    elif topic == MQTT_TEMPERATURE_COMMAND_TOPIC:
-        CURRENT_STATE["temperature"] = msg.decode("utf-8")
-        c.publish(MQTT_TEMPERATURE_STATE_TOPIC, msg, True)
-    else:
-        print("Unknown topic...")
+def record_latency(channel, since):
+    global LATENCY_COUNT, LATENCY_TOTAL, LATENCY_MAX
+
+    latency = time.ticks_diff(channel.last_blast_start, since)
+    if latency < 0:
+        # Queued behind another transmission, not started yet
+        return
+
+    # Reported with the memory diagnostics, printing here would allocate
+    LATENCY_COUNT += 1
+    LATENCY_TOTAL += latency
+    if latency > LATENCY_MAX:
+        LATENCY_MAX = latency
+
+
+def publish_diagnostics():
+    # Collects while nothing else runs, so commands rarely hit a collection
+    memory.collect()
+    if not ONLINE:
+        return
+
+    report = memory.summary()
+    report["commands_merged"] = COMMANDS_MERGED
+    report["commands_unchanged"] = COMMANDS_UNCHANGED
+    report["blasts_suppressed"] = BLASTS_SUPPRESSED
+    report["publishes_suppressed"] = PUBLISHES_SUPPRESSED
+    report["saves_skipped"] = sum(unit.journal.skipped for unit in units)
+    report["schedule_entries"] = scheduler.count
+    report["schedule_fired"] = scheduler.fired
+    report["latency_avg_ms"] = (
+        LATENCY_TOTAL // LATENCY_COUNT // 1000 if LATENCY_COUNT else 0
+    )
+    report["latency_max_ms"] = LATENCY_MAX // 1000
+    report["mqtt_inflight"] = c.inflight
+    report["mqtt_inflight_max"] = c.inflight_max
+    report["mqtt_retries"] = c.retries
+    report["mqtt_reconnects"] = c.reconnects
+    report["mqtt_detect_ms"] = c.detect_ms
+    report["mqtt_reconnect_ms"] = c.reconnect_ms
+    report["offline_count"] = OFFLINE_COUNT
+    report["offline_ms"] = OFFLINE_MS
+    try:
+        c.publish(MQTT_MEMORY_TOPIC, json.dumps(report), True)
+    except OSError as e:
+        go_offline("MQTT error: " + str(e))
+
+
+def start_session():
+    # Returns True once the MQTT session is up, otherwise retries later
+    global ONLINE, _reconnect_attempt
 
     try:
-        send_daikin_state(
-            CURRENT_STATE["power"],
-            CURRENT_STATE["mode"],
-            CURRENT_STATE["temperature"],
-            CURRENT_STATE["fan_mode"],
+        start_mqtt_client()
+    except OSError as e:
+        print("MQTT connection failed: " + str(e))
+        schedule_reconnect()
+        return False
+
+    ONLINE = True
+    _reconnect_attempt = 0
+    watch_mqtt_socket()
+    if not BOOT_READY_MS:
+        boot_ready()
+    return True
+
+
+def go_offline(reason):
+    global ONLINE, MQTT_SOCK, OFFLINE_COUNT, _offline_since
+
+    if not ONLINE:
+        return
+
+    ONLINE = False
+    OFFLINE_COUNT += 1
+    _offline_since = time.ticks_ms()
+    print("Offline ({0}), IR keeps the last state".format(reason))
+
+    if MQTT_SOCK is not None:
+        loop.remove_reader(MQTT_SOCK)
+        MQTT_SOCK = None
+    try:
+        c.sock.close()
+    except OSError:
+        pass
+
+    schedule_reconnect()
+
+
+def schedule_reconnect():
+    global _reconnect_attempt
+
+    _reconnect_attempt += 1
+    loop.call_later(c.backoff_ms(_reconnect_attempt), try_reconnect)
+
+
+def try_reconnect():
+    global OFFLINE_MS
+
+    status = wlan.status()
+    if status == network.STAT_GOT_IP:
+        if start_session() and _offline_since:
+            OFFLINE_MS = time.ticks_diff(time.ticks_ms(), _offline_since)
+            print("Back online after {0} ms".format(OFFLINE_MS))
+        return
+
+    if status != network.STAT_CONNECTING and status != _LINK_NOIP:
+        # Joining goes on in the background, the next attempt checks on it
+        print("Reconnecting to Network: " + str(status))
+        wlan.connect(SSID, PASSWORD)
+    schedule_reconnect()
+
+
+def watch_mqtt_socket():
+    # The robust client opens a new socket whenever it reconnects
+    global MQTT_SOCK
+
+    if c.sock is MQTT_SOCK:
+        return
+
+    if MQTT_SOCK is not None:
+        loop.remove_reader(MQTT_SOCK)
+
+        # Reconnected: the broker may have published the will meanwhile and
+        # forgot the subscriptions, the session is set up again
+        print(
+            "MQTT reconnected: dead for {0} ms before detection, back in {1} ms".format(
+                c.detect_ms, c.reconnect_ms
+            )
         )
+        MQTT_SOCK = None
+        publish_session()
 
-        save_state()
-    except RemoteException as e:
-        print("Error while sending state through IR: " + str(e))
+    MQTT_SOCK = c.sock
+    loop.add_reader(MQTT_SOCK, service_mqtt)
+
+
+def service_mqtt():
+    # Process MQTT message
+    try:
+        c.check_msg()
+        watch_mqtt_socket()
+    except OSError as e:
+        go_offline("MQTT error: " + str(e))
+
+
+def check_mqtt():
+    if not ONLINE:
+        return
+
+    try:
+        c.check_keepalive()
+        c.resend_expired()
+        watch_mqtt_socket()
+    except OSError as e:
+        go_offline("MQTT error: " + str(e))
+
+
+def complete_ir():
+    ir_done.clear()
+    poll_send()
+
+
+def check_network():
+    if ONLINE and wlan.status() != network.STAT_GOT_IP:
+        go_offline("network status " + str(wlan.status()))
+
+
+def load_ir_timings():
+    # Returns True if a calibration ran before, its timings were installed
+    try:
+        with open(IR_TIMING_PATH, "r") as f:
+            saved = json.load(f)
+        timings = saved["timings"]
+    except Exception:
+        return False
+
+    nominal = daikinremote.SYMBOL_DURATIONS
+    if len(timings) != len(nominal):
+        return False
+    for i in range(len(nominal)):
+        if not nominal[i] // 2 <= timings[i] <= nominal[i] * 3 // 2:
+            return False
+
+    daikinremote.set_timings(timings)
+    if saved.get("ok", True):
+        print("Loaded IR timings: " + str(timings))
+    else:
+        print("Last IR calibration failed, calibrate/set runs it again")
+    return True
+
+
+def save_ir_timings():
+    if flash_write_deferred(ir_timing_save_timer):
+        return
+    with open(IR_TIMING_PATH, "w") as f:
+        json.dump({"timings": list(daikinremote.TIMINGS), "ok": ir_calibration_ok}, f)
+
+
+ir_timing_save_timer = loop.timer(save_ir_timings)
+
+
+def calibrate_ir(msg=None):
+    # Sends the state of the first unit, which it already has, while the
+    # loopback receiver captures it. Any payload on calibrate/set runs it.
+    global ir_calibration, ir_calibration_ok
+
+    for unit in units:
+        if unit.channel.busy():
+            loop.call_later(CALIBRATION_RETRY_MS, calibrate_ir)
+            return
+
+    unit = units[0]
+    if ir_calibration is None:
+        ir_calibration = Calibration(unit.channel.backend, EdgeCapture(IR_RECEIVER_PIN))
+
+    # Through the state cache, so frame 2 keeps the unit clock like any send
+    state = unit.state
+    key = daikinremote.state_key(
+        state["power"], state["mode"], state_temperature(state), state["fan_mode"]
+    )
+    cache = unit.channel.state_cache
+    cache.get(key)
+    ok = ir_calibration.run(cache.state_raw(key))
+
+    report = {
+        "ok": ok,
+        "rounds": ir_calibration.rounds,
+        "mismatches": ir_calibration.mismatches,
+    }
+    for i in range(len(daikinremote.SYMBOL_NAMES)):
+        name = daikinremote.SYMBOL_NAMES[i]
+        report[name] = ir_calibration.timings[i]
+        report[name + "_error"] = ir_calibration.errors[i]
+    print("IR calibration: " + str(report))
+
+    # Failed, the timings in use stay and are saved along with the failure
+    if ok:
+        daikinremote.set_timings(ir_calibration.timings)
+    ir_calibration_ok = ok
+    save_ir_timings()
+
+    if ONLINE:
+        try:
+            c.publish(MQTT_CALIBRATION_TOPIC, json.dumps(report), True)
+        except OSError as e:
+            go_offline("MQTT error: " + str(e))
+
+
+if IR_RECEIVER_PIN is not None:
+    COMMAND_HANDLERS.add(MQTT_CALIBRATE_COMMAND_TOPIC, calibrate_ir)
+
+
+def sync_clock():
+    global CLOCK_SYNCED, _clock_synced_at
+
+    try:
+        ntptime.settime()
+    except (OSError, OverflowError) as e:
+        print("Clock sync failed: " + str(e))
+        return
+
+    CLOCK_SYNCED = True
+    _clock_synced_at = time.ticks_ms()
+    if apply_schedule():
+        save_schedule()
+
+
+def check_clock():
+    if not ONLINE:
+        return
+
+    if (
+        not CLOCK_SYNCED
+        or time.ticks_diff(time.ticks_ms(), _clock_synced_at) >= CLOCK_SYNC_PERIOD_MS
+    ):
+        sync_clock()
+
+
+def start_watchdog():
+    global watchdog
+
+    if WATCHDOG_MS is None:
+        return
+
+    watchdog = machine.WDT(timeout=WATCHDOG_MS)
+    loop.call_every(WATCHDOG_MS // 4, feed_watchdog)
 
 
 def main():
     try:
+        boot_phase("init")
         load_state()
+        load_schedule()
+        calibrated = load_ir_timings()
+        build_discovery()
+        boot_phase("flash")
 
-        connect_to_network()
-
-        start_mqtt_client()
+        daikinremote.set_done_signal(ir_done)
+        loop.add_reader(ir_done, complete_ir)
 
-        while True:
-            time.sleep_ms(100)
+        # Without a network the board starts offline and keeps trying
+        if not connect_to_network():
+            schedule_reconnect()
+        elif start_session() and NETWORK_CACHE is None:
+            loop.call_later(NETWORK_CHECK_PERIOD_MS, save_network_cache)
+        check_clock()
+        if IR_RECEIVER_PIN is not None and not calibrated:
+            calibrate_ir()
 
-            # Process MQTT message
-            c.check_msg()
+        start_watchdog()
+        loop.call_every(NETWORK_CHECK_PERIOD_MS, check_network)
+        loop.call_every(MQTT_CHECK_PERIOD_MS, check_mqtt)
+        loop.call_every(DIAGNOSTICS_PERIOD_MS, publish_diagnostics)
+        loop.call_every(CLOCK_CHECK_PERIOD_MS, check_clock)
+        loop.call_every(SCHEDULE_TICK_MS, tick_schedule)
 
-            # Validate WiFi status
-            if wlan.status() != 3:
-                process_failed_network(wlan.status())
+        loop.run()
     except Exception as e:
         print("Fatal error: " + str(e))
+        flush_state()
         print("Sleeping 10 seconds then resetting!")
         time.sleep(10)
         machine.reset()
     except KeyboardInterrupt:
         print("Keyboard interrupt, exiting...")
-        close_mqtt_client()
+        flush_state()
+        if ONLINE:
+            close_mqtt_client()
 
 
 main()
@@ -0,0 +1,78 @@
+import gc
+import time
+
+
+class MemoryProbe:
+    """Heap usage of the command path.
+
+    mark() and count() bracket a piece of the command path and add the
+    bytes it allocated (gc.mem_alloc() delta) to the total. sample() tracks
+    the gc.mem_free() low-water mark and notices the automatic collections
+    that ran since the last sample. collect() runs a timed collection.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.allocated = 0
+        self.allocated_max = 0
+
+        self.free_min = gc.mem_free()
+        self.collections = 0
+        self.auto_collections = 0
+        self.gc_us_total = 0
+        self.gc_us_max = 0
+
+        self._mark = 0
+        self._last_alloc = gc.mem_alloc()
+
+    def mark(self):
+        self._mark = gc.mem_alloc()
+
+    def count(self):
+        allocated = gc.mem_alloc() - self._mark
+        if allocated < 0:
+            # A collection ran in between, the figure is meaningless
+            self.auto_collections += 1
+            return
+
+        self.allocated += allocated
+        if allocated > self.allocated_max:
+            self.allocated_max = allocated
+
+    def sample(self):
+        free = gc.mem_free()
+        if free < self.free_min:
+            self.free_min = free
+
+        alloc = gc.mem_alloc()
+        if alloc < self._last_alloc:
+            self.auto_collections += 1
+        self._last_alloc = alloc
+
+    def collect(self):
+        # Returns the pause in us
+        self.sample()
+        start = time.ticks_us()
+        gc.collect()
+        pause = time.ticks_diff(time.ticks_us(), start)
+        self._last_alloc = gc.mem_alloc()
+
+        self.collections += 1
+        self.gc_us_total += pause
+        if pause > self.gc_us_max:
+            self.gc_us_max = pause
+        return pause
+
+    def summary(self):
+        return {
+            "free": gc.mem_free(),
+            "free_min": self.free_min,
+            "alloc": gc.mem_alloc(),
+            "commands": self.commands,
+            "bytes_per_command": self.allocated // self.commands if self.commands else 0,
+            "bytes_max": self.allocated_max,
+            "collections": self.collections,
+            "auto_collections": self.auto_collections,
+            "gc_us_avg": self.gc_us_total // self.collections if self.collections else 0,
+            "gc_us_max": self.gc_us_max,
+        }
@@ -0,0 +1,129 @@
+from micropython import const
+from array import array
+import time
+
+# Wheel slots, one minute each. An entry further away than that waits for
+# its slot to come around again, counting the turns down in _rounds.
+_SLOTS = const(64)
+
+MINUTES_PER_DAY = const(1440)
+MINUTES_PER_WEEK = const(10080)
+
+# Furthest an entry can be, its turns count has to fit in _rounds
+MAX_DELAY = const(_SLOTS * 0x10000)
+
+
+def epoch_minute(seconds=None):
+    return (time.time() if seconds is None else seconds) // 60
+
+
+def minute_of_week(minute):
+    # Monday 00:00 is 0. minute already includes any UTC offset.
+    t = time.gmtime(minute * 60)
+    return t[6] * MINUTES_PER_DAY + t[3] * 60 + t[4]
+
+
+class Scheduler:
+    """Weekly programs and one-shot timers on a hashed timer wheel.
+
+    Entries live in preallocated arrays, chained per slot. Each tick only
+    walks the entries of the slot for that minute, so its cost doesn't
+    depend on how many entries there are or how far away they are. A fired
+    weekly entry is put back one week later.
+
+    callback(action) is called for every entry that fires, action is the
+    16-bit value given to add().
+    """
+
+    def __init__(self, callback, capacity=64):
+        self.callback = callback
+        self.capacity = capacity
+        self.minute = -1
+        self.fired = 0
+
+        self._heads = array("h", [-1] * _SLOTS)
+        self._next = array("h", [-1] * capacity)
+        self._rounds = array("H", [0] * capacity)
+        self._action = array("H", [0] * capacity)
+        self._period = array("H", [0] * capacity)
+        self.clear()
+
+    def clear(self):
+        for i in range(_SLOTS):
+            self._heads[i] = -1
+        # Free entries are chained from _free
+        for i in range(self.capacity):
+            self._next[i] = i + 1 if i + 1 < self.capacity else -1
+        self._free = 0
+        self.count = 0
+
+    def start(self, minute):
+        # Entries are placed relative to this minute, call clear() first when
+        # the clock jumped
+        self.minute = minute
+
+    def _insert(self, delay, action, period):
+        if delay > MAX_DELAY:
+            raise ValueError("Too far ahead")
+        i = self._free
+        if i < 0:
+            raise ValueError("Schedule full")
+        self._free = self._next[i]
+
+        slot = (self.minute + delay) % _SLOTS
+        self._rounds[i] = (delay - 1) // _SLOTS
+        self._action[i] = action
+        self._period[i] = period
+        self._next[i] = self._heads[slot]
+        self._heads[slot] = i
+        self.count += 1
+
+    def add_weekly(self, minute_of_week_due, action):
+        # Next occurrence of minute_of_week_due, then every week
+        delay = (minute_of_week_due - minute_of_week(self.minute)) % MINUTES_PER_WEEK
+        self._insert(delay or MINUTES_PER_WEEK, action, MINUTES_PER_WEEK)
+
+    def add_once(self, due, action):
+        # Returns False if due (an epoch_minute()) has already passed or is
+        # further than MAX_DELAY
+        delay = due - self.minute
+        if delay <= 0 or delay > MAX_DELAY:
+            return False
+        self._insert(delay, action, 0)
+        return True
+
+    def tick(self, minute):
+        # Runs every minute up to minute, firing the entries that are due
+        if self.minute < 0:
+            return
+
+        while self.minute < minute:
+            self.minute += 1
+            self._run_slot(self.minute % _SLOTS)
+
+    def _run_slot(self, slot):
+        prev = -1
+        i = self._heads[slot]
+        while i >= 0:
+            following = self._next[i]
+            if self._rounds[i]:
+                self._rounds[i] -= 1
+                prev = i
+                i = following
+                continue
+
+            # Unlink, then put back or free
+            if prev < 0:
+                self._heads[slot] = following
+            else:
+                self._next[prev] = following
+            self.count -= 1
+            self._next[i] = self._free
+            self._free = i
+
+            action = self._action[i]
+            if self._period[i]:
+                self._insert(self._period[i], action, self._period[i])
+            self.fired += 1
+            self.callback(action)
+            i = following
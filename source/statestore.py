@@ -0,0 +1,111 @@
+from micropython import const
+from ubinascii import crc32
+import ustruct as struct
+import time
+
+# Record: magic, sequence number, 16 bits of payload, CRC32 of the first 4 bytes
+_RECORD_FORMAT = "<BBHI"
+RECORD_SIZE = const(8)
+_MAGIC = const(0xDA)
+
+
+class StateJournal:
+    """Rotating journal of fixed-size state records on flash.
+
+    Each save goes to the next slot with an incremented sequence number,
+    the newest record with a valid CRC wins at load. Saves are held in
+    memory until flush() and dropped when they match what is on flash.
+    """
+
+    def __init__(self, path, slots=16):
+        self.path = path
+        self.slots = slots
+
+        self.writes = 0
+        self.skipped = 0
+        self.load_us = 0
+
+        self._record = bytearray(RECORD_SIZE)
+        self._slot = -1
+        self._seq = 0
+        self._persisted = None
+        self._pending = None
+
+    def load(self):
+        # Returns the newest valid payload, or None
+        start = time.ticks_us()
+
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+
+        view = memoryview(data)
+        best_slot = -1
+        best_seq = 0
+        best_payload = None
+        for slot in range(min(len(data) // RECORD_SIZE, self.slots)):
+            offset = slot * RECORD_SIZE
+            magic, seq, payload, crc = struct.unpack_from(_RECORD_FORMAT, data, offset)
+            if magic != _MAGIC or crc != crc32(view[offset : offset + 4]):
+                continue
+
+            # Sequence numbers wrap, a record is newer if it is less than half a turn ahead
+            if best_slot < 0 or 0 < (seq - best_seq) & 0xFF < 0x80:
+                best_slot = slot
+                best_seq = seq
+                best_payload = payload
+
+        if best_slot >= 0:
+            self._slot = best_slot
+            self._seq = best_seq
+        self._persisted = best_payload
+
+        self.load_us = time.ticks_diff(time.ticks_us(), start)
+        return best_payload
+
+    def save(self, payload):
+        # Returns True when the payload needs a flush() to reach flash
+        if payload == self._persisted:
+            self._pending = None
+            self.skipped += 1
+            return False
+
+        if payload == self._pending:
+            self.skipped += 1
+            return False
+
+        scheduled = self._pending is not None
+        self._pending = payload
+        return not scheduled
+
+    def pending(self):
+        return self._pending is not None
+
+    def flush(self):
+        if self._pending is None:
+            return False
+
+        self._slot = (self._slot + 1) % self.slots
+        self._seq = (self._seq + 1) & 0xFF
+
+        record = self._record
+        struct.pack_into(_RECORD_FORMAT, record, 0, _MAGIC, self._seq, self._pending, 0)
+        struct.pack_into("<I", record, 4, crc32(memoryview(record)[0:4]))
+
+        try:
+            f = open(self.path, "r+b")
+        except OSError:
+            # First save, lay out the whole journal
+            f = open(self.path, "wb")
+            f.write(bytearray(RECORD_SIZE * self.slots))
+
+        with f:
+            f.seek(self._slot * RECORD_SIZE)
+            f.write(record)
+
+        self.writes += 1
+        self._persisted = self._pending
+        self._pending = None
+        return True
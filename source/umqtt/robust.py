@@ -1,13 +1,31 @@
 import utime
+import urandom
 from . import simple
 
 
 class MQTTClient(simple.MQTTClient):
-    DELAY = 2
+    # Reconnect attempts back off exponentially from DELAY_MS up to
+    # MAX_DELAY_MS, with half of each delay randomized
+    DELAY_MS = 500
+    MAX_DELAY_MS = 30000
+    # Failed connects before reconnect() gives up and raises, 0 never gives up
+    MAX_ATTEMPTS = 0
     DEBUG = False
 
+    # Reconnect metrics (ms): time since the last received packet when the
+    # connection was found dead, and how long getting back took
+    reconnects = 0
+    detect_ms = 0
+    reconnect_ms = 0
+
+    def backoff_ms(self, i):
+        d = self.DELAY_MS << min(i - 1, 16)
+        if d > self.MAX_DELAY_MS:
+            d = self.MAX_DELAY_MS
+        return d // 2 + (urandom.getrandbits(16) * (d // 2) >> 16)
+
     def delay(self, i):
-        utime.sleep(self.DELAY)
+        utime.sleep_ms(self.backoff_ms(i))
 
     def log(self, in_reconnect, e):
         if self.DEBUG:
@@ -17,21 +35,64 @@ class MQTTClient(simple.MQTTClient):
                 print("mqtt: %r" % e)
 
     def reconnect(self):
+        start = utime.ticks_ms()
+        self.detect_ms = utime.ticks_diff(start, self._last_rx)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
         i = 0
         while 1:
             try:
-                return super().connect(False)
+                present = super().connect(False)
+                self.reconnects += 1
+                self.reconnect_ms = utime.ticks_diff(utime.ticks_ms(), start)
+                return present
             except OSError as e:
                 self.log(True, e)
                 i += 1
+                if i == self.MAX_ATTEMPTS:
+                    raise
                 self.delay(i)
 
     def publish(self, topic, msg, retain=False, qos=0):
         while 1:
+            pending = self._len
             try:
                 return super().publish(topic, msg, retain, qos)
             except OSError as e:
                 self.log(False, e)
+            # A packet built before the failure is sent from the buffer, the
+            # reconnect may already have flushed it
+            built = self._len > pending
+            self.reconnect()
+            if built:
+                self.flush()
+                return self.pid if qos else None
+
+    def resend_expired(self):
+        while 1:
+            try:
+                return super().resend_expired()
+            except OSError as e:
+                self.log(False, e)
+            self.reconnect()
+
+    def check_keepalive(self):
+        while 1:
+            try:
+                return super().check_keepalive()
+            except OSError as e:
+                self.log(False, e)
+            self.reconnect()
+
+    def flush(self):
+        # Batched packets survive reconnect() and are sent again
+        while 1:
+            try:
+                return super().flush()
+            except OSError as e:
+                self.log(False, e)
             self.reconnect()
 
     def wait_msg(self):
@@ -1,12 +1,25 @@
+import uselect
 import usocket as socket
 import ustruct as struct
+import utime
+from array import array
 from ubinascii import hexlify
+from micropython import const
 
 
 class MQTTException(Exception):
     pass
 
 
+_VIEW_CACHE_SIZE = const(16)
+
+
+def _to_bytes(s):
+    if isinstance(s, str):
+        return s.encode()
+    return s
+
+
 class MQTTClient:
     def __init__(
         self,
@@ -18,6 +31,11 @@ class MQTTClient:
         keepalive=0,
         ssl=False,
         ssl_params={},
+        buf_size=256,
+        rbuf_size=256,
+        max_inflight=4,
+        retry_ms=5000,
+        ping_timeout_ms=5000,
     ):
         if port == 0:
             port = 8883 if ssl else 1883
@@ -36,21 +54,216 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # Outgoing packets are assembled here and sent with a single write
+        self._buf = bytearray(buf_size)
+        self._len = 0
+        self._batching = False
+        # Incoming packets are read in place, see wait_msg()
+        self._hdr = bytearray(1)
+        self._rbuf = bytearray(rbuf_size)
+        self._rview = memoryview(self._rbuf)
+        self._views = {}
+        self._puback = bytearray(b"\x40\x02\0\0")
+        self._ack = bytearray(2)
+        # QoS 1 publishes waiting for their PUBACK: packet id (0 for a free
+        # slot), ticks_ms() of the last send and a copy of the packet
+        self.max_inflight = max_inflight
+        self.retry_ms = retry_ms
+        self.inflight = 0
+        self.inflight_max = 0
+        self.retries = 0
+        self._pids = array("H", [0] * max_inflight)
+        self._sent = array("L", [0] * max_inflight)
+        self._pkt_lens = array("H", [0] * max_inflight)
+        self._pkts = [bytearray(0) for _ in range(max_inflight)]
+        # Bit i is set while the packet of slot i waits in the batch buffer
+        self._unflushed = 0
+        # Keepalive: ticks_ms() of the last packet sent and received, and of
+        # the PINGREQ waiting for its PINGRESP (-1 when none)
+        self.ping_timeout_ms = ping_timeout_ms
+        self._last_tx = 0
+        self._last_rx = 0
+        self._ping_sent = -1
+        # Poller of sock, for the waits bounded by ping_timeout_ms
+        self._poll = None
+        self._polled = None
+        # Called before each of those waits and before each blocking step of
+        # connect(), e.g. to feed a watchdog
+        self.on_wait = None
+        # Broker address, resolved again after a failed connect
+        self._addr = None
+
+    def _reserve(self, n):
+        size = self._len + n
+        if size > len(self._buf):
+            buf = bytearray(size)
+            buf[: self._len] = self._buf[: self._len]
+            self._buf = buf
+
+    def _pkt_start(self, op, sz):
+        # Reserves room for the whole packet and writes its fixed header
+        self._reserve(sz + 5)
+        buf = self._buf
+        i = self._len
+        buf[i] = op
+        i += 1
+        while sz > 0x7F:
+            buf[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        self._len = i + 1
+
+    def _pkt_bytes(self, b):
+        n = len(b)
+        self._buf[self._len : self._len + n] = b
+        self._len += n
+
+    def _pkt_str(self, s):
+        struct.pack_into("!H", self._buf, self._len, len(s))
+        self._len += 2
+        self._pkt_bytes(s)
+
+    def _pkt_send(self):
+        if not self._batching:
+            self.flush()
+
+    # Packets published between begin_batch() and flush() are sent
+    # together with a single socket write.
+    def begin_batch(self):
+        self._batching = True
+
+    def flush(self):
+        self._batching = False
+        if self._len:
+            self.sock.write(self._buf, self._len)
+            self._len = 0
+            self._unflushed = 0
+            self._last_tx = utime.ticks_ms()
+
+    def _next_pid(self):
+        # Packet ids are 16 bits and never 0, ids still in flight are skipped
+        pid = self.pid
+        while 1:
+            pid = pid + 1 if pid < 0xFFFF else 1
+            if self._slot(pid) < 0:
+                self.pid = pid
+                return pid
+
+    def _slot(self, pid):
+        pids = self._pids
+        for i in range(self.max_inflight):
+            if pids[i] == pid:
+                return i
+        return -1
+
+    def _track(self, slot, pid, start):
+        # Keeps a copy of the packet assembled from start for retransmission
+        n = self._len - start
+        pkt = self._pkts[slot]
+        if len(pkt) < n:
+            pkt = bytearray(n)
+            self._pkts[slot] = pkt
+        buf = self._buf
+        for i in range(n):
+            pkt[i] = buf[start + i]
+        self._pkt_lens[slot] = n
+        self._pids[slot] = pid
+        self._unflushed |= 1 << slot
+        self._sent[slot] = utime.ticks_ms()
+        self.inflight += 1
+        if self.inflight > self.inflight_max:
+            self.inflight_max = self.inflight
+
+    def _acked(self, pid):
+        i = self._slot(pid)
+        if i >= 0:
+            self._pids[i] = 0
+            self.inflight -= 1
+
+    def _resend(self, i, now):
+        pkt = self._pkts[i]
+        pkt[0] |= 0x08  # DUP
+        self.flush()
+        self.sock.write(pkt, self._pkt_lens[i])
+        self._sent[i] = now
+        self._last_tx = now
+        self.retries += 1
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    # Sends QoS 1 publishes again (with the DUP flag) once their PUBACK is
+    # more than retry_ms late. Meant to be called periodically.
+    def resend_expired(self):
+        if not self.inflight:
+            return
+        now = utime.ticks_ms()
+        # Packets still in the batch were never sent, they go out with it
+        unflushed = self._unflushed
+        for i in range(self.max_inflight):
+            if (
+                self._pids[i]
+                and not unflushed >> i & 1
+                and utime.ticks_diff(now, self._sent[i]) >= self.retry_ms
+            ):
+                self._resend(i, now)
+
+    # Waits for the next packet and processes it like wait_msg(), raises
+    # OSError if none comes within ping_timeout_ms
+    def _wait_reply(self):
+        if self.on_wait is not None:
+            self.on_wait()
+        if self._polled is not self.sock:
+            self._poll = uselect.poll()
+            self._poll.register(self.sock, uselect.POLLIN)
+            self._polled = self.sock
+        if not self._poll.poll(self.ping_timeout_ms):
+            raise OSError(110)  # ETIMEDOUT
+        self.sock.setblocking(True)
+        return self.wait_msg()
+
+    # Waits until every QoS 1 publish has been acknowledged
+    def wait_acks(self):
+        while self.inflight:
+            self._wait_reply()
+
+    # Sends a PINGREQ once nothing was sent for 3/4 of the keepalive period,
+    # and raises OSError when its PINGRESP is more than ping_timeout_ms late.
+    # Meant to be called periodically.
+    def check_keepalive(self):
+        if not self.keepalive:
+            return
+        now = utime.ticks_ms()
+        if self._ping_sent >= 0:
+            if utime.ticks_diff(now, self._ping_sent) > self.ping_timeout_ms:
+                self._ping_sent = -1
+                raise OSError(110)  # ETIMEDOUT
+            return
+        if utime.ticks_diff(now, self._last_tx) >= self.keepalive * 750:
+            self.ping()
 
     def _recv_len(self):
+        hdr = self._hdr
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            self.sock.readinto(hdr, 1)
+            b = hdr[0]
             n |= (b & 0x7F) << sh
             if not b & 0x80:
                 return n
             sh += 7
 
+    def _view(self, start, end):
+        # Topics and payload sizes repeat, so caching the views over the
+        # receive buffer keeps steady-state receiving allocation free.
+        key = start << 16 | end
+        view = self._views.get(key)
+        if view is None:
+            if len(self._views) >= _VIEW_CACHE_SIZE:
+                self._views = {}
+            view = self._rview[start:end]
+            self._views[key] = view
+        return view
+
     def set_callback(self, f):
         self.cb = f
 
@@ -62,147 +275,204 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
+    # Connecting, the TLS handshake and CONNACK each give up after
+    # ping_timeout_ms, the socket blocks without a timeout afterwards
     def connect(self, clean_session=True):
-        self.sock = socket.socket()
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
-        self.sock.connect(addr)
+        on_wait = self.on_wait
+        if on_wait is not None:
+            on_wait()
+        if self._addr is None:
+            self._addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        sock = self.sock = socket.socket()
+        sock.settimeout(self.ping_timeout_ms / 1000)
+        if on_wait is not None:
+            on_wait()
+        try:
+            sock.connect(self._addr)
+        except OSError:
+            self._addr = None
+            raise
         if self.ssl:
             import ussl
 
-            self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+            if on_wait is not None:
+                on_wait()
+            self.sock = ussl.wrap_socket(sock, **self.ssl_params)
+        client_id = _to_bytes(self.client_id)
+        user = _to_bytes(self.user)
+        pswd = _to_bytes(self.pswd)
+        lw_topic = _to_bytes(self.lw_topic)
+        lw_msg = _to_bytes(self.lw_msg)
+
+        msg = bytearray(b"\0\x04MQTT\x04\x02\0\0")
 
-        sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
-        if self.user is not None:
-            sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
+        sz = 10 + 2 + len(client_id)
+        msg[7] = clean_session << 1
+        if user is not None:
+            sz += 2 + len(user) + 2 + len(pswd)
+            msg[7] |= 0xC0
         if self.keepalive:
             assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
-        if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
-
-        i = 1
-        while sz > 0x7F:
-            premsg[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        premsg[i] = sz
-
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
-        # print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
-        if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
-        if self.user is not None:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
+            msg[8] |= self.keepalive >> 8
+            msg[9] |= self.keepalive & 0x00FF
+        if lw_topic:
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg)
+            msg[7] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            msg[7] |= self.lw_retain << 5
+
+        # Packets batched before a reconnect stay in front of the buffer,
+        # CONNECT is built after them and sent on its own.
+        mark = self._len
+        self._pkt_start(0x10, sz)
+        self._pkt_bytes(msg)
+        self._pkt_str(client_id)
+        if lw_topic:
+            self._pkt_str(lw_topic)
+            self._pkt_str(lw_msg)
+        if user is not None:
+            self._pkt_str(user)
+            self._pkt_str(pswd)
+        self.sock.write(memoryview(self._buf)[mark : self._len])
+        self._len = mark
+
+        if on_wait is not None:
+            on_wait()
         resp = self.sock.read(4)
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
+        sock.settimeout(None)
+        self._last_tx = self._last_rx = utime.ticks_ms()
+        self._ping_sent = -1
+
+        # A resumed session expects unacknowledged publishes again, except
+        # those still in the batch: they were never sent and go out with it
+        now = utime.ticks_ms()
+        unflushed = self._unflushed
+        for i in range(self.max_inflight):
+            if self._pids[i]:
+                if clean_session:
+                    self._pids[i] = 0
+                elif not unflushed >> i & 1:
+                    self._resend(i, now)
+        if clean_session:
+            self.inflight = 0
         return resp[2] & 1
 
     def disconnect(self):
+        self.flush()
         self.sock.write(b"\xe0\0")
         self.sock.close()
 
     def ping(self):
         self.sock.write(b"\xc0\0")
+        self._ping_sent = self._last_tx = utime.ticks_ms()
 
+    # QoS 1 publishes don't wait for their PUBACK: they are kept in a table of
+    # max_inflight entries until acknowledged, see resend_expired(). Only a
+    # publish finding the table full waits, processing incoming packets until
+    # a slot is free.
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+        assert qos <= 1
+        topic = _to_bytes(topic)
+        msg = _to_bytes(msg)
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
+            slot = self._slot(0)
+            while slot < 0:
+                self._wait_reply()
+                slot = self._slot(0)
         assert sz < 2097152
-        i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        start = self._len
+        self._pkt_start(0x30 | qos << 1 | retain, sz)
+        self._pkt_str(topic)
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+            pid = self._next_pid()
+            struct.pack_into("!H", self._buf, self._len, pid)
+            self._len += 2
+        self._pkt_bytes(msg)
+        if qos > 0:
+            self._track(slot, pid, start)
+            self._pkt_send()
+            return pid
+        self._pkt_send()
 
+    # topic can also be a list of topics, subscribed to with a single packet
     def subscribe(self, topic, qos=0):
         assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
+        topics = topic if isinstance(topic, (list, tuple)) else (topic,)
+        sz = 2
+        for t in topics:
+            sz += 2 + len(_to_bytes(t)) + 1
+        pid = self._next_pid()
+        self._pkt_start(0x82, sz)
+        struct.pack_into("!H", self._buf, self._len, pid)
+        self._len += 2
+        for t in topics:
+            self._pkt_str(_to_bytes(t))
+            self._buf[self._len] = qos
+            self._len += 1
+        self.flush()
         while 1:
-            op = self.wait_msg()
+            op = self._wait_reply()
             if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+                sz = self._recv_len()
+                resp = self.sock.read(sz)
+                assert resp[0] == pid >> 8 & 0xFF and resp[1] == pid & 0xFF
+                assert sz == 2 + len(topics)
+                for i in range(2, sz):
+                    if resp[i] == 0x80:
+                        raise MQTTException(resp[i])
                 return
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
+    # Topic and message are memoryviews over the receive buffer, they
+    # are only valid until the callback returns.
     def wait_msg(self):
-        res = self.sock.read(1)
+        hdr = self._hdr
+        res = self.sock.readinto(hdr, 1)
         self.sock.setblocking(True)
         if res is None:
             return None
-        if res == b"":
+        if res == 0:
             raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
+        self._last_rx = utime.ticks_ms()
+        op = hdr[0]
+        if op == 0xD0:  # PINGRESP
+            self.sock.readinto(hdr, 1)
+            assert hdr[0] == 0
+            self._ping_sent = -1
             return None
-        op = res[0]
+        if op == 0x40:  # PUBACK
+            sz = self._recv_len()
+            assert sz == 2
+            ack = self._ack
+            self.sock.readinto(ack, 2)
+            self._acked(ack[0] << 8 | ack[1])
+            return op
         if op & 0xF0 != 0x30:
             return op
         sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
+        if sz > len(self._rbuf):
+            self._rbuf = bytearray(sz)
+            self._rview = memoryview(self._rbuf)
+            self._views = {}
+        buf = self._rbuf
+        self.sock.readinto(buf, sz)
+        topic_len = buf[0] << 8 | buf[1]
+        pos = 2 + topic_len
         if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
+            pid = buf[pos] << 8 | buf[pos + 1]
+            pos += 2
+        self.cb(self._view(2, 2 + topic_len), self._view(pos, sz))
         if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
+            pkt = self._puback
+            pkt[2] = pid >> 8
+            pkt[3] = pid & 0xFF
             self.sock.write(pkt)
         elif op & 6 == 4:
             assert 0